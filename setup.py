@@ -77,16 +77,29 @@ setup(
         'zope.i18nmessageid',
         'zope.interface >= 3.8',
         'zope.location',
+        'zope.proxy',
         'zope.schema',
         'zope.security',
     ],
     extras_require=dict(
         test=[
+            'BTrees',
+            'ZODB',
+            'transaction >= 3.0',
+            'zope.intid',
             'zope.testing',
             'zope.testrunner',
         ],
         dublincore=[
             'zope.dublincore >= 3.7',
+        ],
+        btrees=[
+            'BTrees',
+        ],
+        grantindex=[
+            'BTrees',
+            'transaction >= 3.0',
+            'zope.intid',
         ]),
     include_package_data=True,
     zip_safe=False,
@@ -0,0 +1,235 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Index of the objects with local grants
+
+This requires the BTrees, transaction and zope.intid packages (the
+``grantindex`` extra).  Objects are indexed by their integer ids, so only
+objects registered with an `IIntIds` utility are indexed.
+"""
+import itertools
+
+import BTrees
+import transaction
+from persistent import Persistent
+from zope.component import adapter
+from zope.component import getUtility
+from zope.component import queryUtility
+from zope.interface import implementer
+from zope.intid.interfaces import IIntIdAddedEvent
+from zope.intid.interfaces import IIntIdRemovedEvent
+from zope.intid.interfaces import IIntIds
+
+from zope.securitypolicy.interfaces import IHasLocalGrants
+from zope.securitypolicy.interfaces import ILocalGrantIndex
+from zope.securitypolicy.principalpermission import \
+    AnnotationPrincipalPermissionManager
+from zope.securitypolicy.principalpermission import principalPermissionManager
+from zope.securitypolicy.principalrole import AnnotationPrincipalRoleManager
+from zope.securitypolicy.principalrole import principalRoleManager
+from zope.securitypolicy.securitymap import batchedChanges
+from zope.securitypolicy.securitymap import localGrantIds
+
+
+KINDS = ('principal', 'role', 'permission')
+
+
+@implementer(ILocalGrantIndex)
+class LocalGrantIndex(Persistent):
+    """Index of the objects with local grants, to register as a utility
+
+    The object ids are kept, by id, in a BTree for every kind of id, so
+    looking up the objects of an id takes logarithmic time.
+    """
+
+    family = BTrees.family64
+
+    def __init__(self, family=None):
+        if family is not None:
+            self.family = family
+        # The ids of the objects with grants, by kind and id
+        self._objects = {kind: self.family.OO.BTree() for kind in KINDS}
+        # How many security maps of an object have grants for an id, by
+        # object id and (kind, id)
+        self._counts = self.family.IO.BTree()
+
+    def _intid(self, context):
+        intids = queryUtility(IIntIds)
+        if intids is None:
+            return None
+        return intids.queryId(context)
+
+    def update(self, context, added=(), removed=()):
+        '''See interface ILocalGrantIndex'''
+        uid = self._intid(context)
+        if uid is None:
+            return
+        counts = self._counts.get(uid)
+        if counts is None:
+            counts = self.family.OI.BTree()
+
+        for kind, id in added:
+            key = kind, id
+            count = counts.get(key, 0)
+            counts[key] = count + 1
+            if not count:
+                objects = self._objects[kind]
+                uids = objects.get(id)
+                if uids is None:
+                    uids = objects[id] = self.family.II.TreeSet()
+                uids.add(uid)
+
+        for kind, id in removed:
+            key = kind, id
+            count = counts.get(key, 0)
+            if count > 1:
+                counts[key] = count - 1
+            elif count:
+                del counts[key]
+                self._removeObject(kind, id, uid)
+
+        if counts:
+            if self._counts.get(uid) is not counts:
+                self._counts[uid] = counts
+        elif uid in self._counts:
+            del self._counts[uid]
+
+    def _removeObject(self, kind, id, uid):
+        objects = self._objects[kind]
+        uids = objects.get(id)
+        if uids is not None:
+            uids.discard(uid)
+            if not uids:
+                del objects[id]
+
+    def indexObject(self, context):
+        '''See interface ILocalGrantIndex'''
+        self.unindexObject(context)
+        self.update(context, localGrantIds(context))
+
+    def unindexObject(self, context):
+        '''See interface ILocalGrantIndex'''
+        uid = self._intid(context)
+        if uid is None:
+            return
+        counts = self._counts.pop(uid, None)
+        if counts is not None:
+            for kind, id in counts:
+                self._removeObject(kind, id, uid)
+
+    def getObjectIds(self, kind, id):
+        '''See interface ILocalGrantIndex'''
+        return self._objects[kind].get(id, ())
+
+    def getObjects(self, kind, id):
+        '''See interface ILocalGrantIndex'''
+        intids = getUtility(IIntIds)
+        for uid in self.getObjectIds(kind, id):
+            ob = intids.queryObject(uid)
+            if ob is not None:
+                yield ob
+
+
+@adapter(IHasLocalGrants, IIntIdAddedEvent)
+def indexLocalGrants(ob, event):
+    """Index the grants of objects with grants when they get an int id"""
+    index = queryUtility(ILocalGrantIndex)
+    if index is not None:
+        index.indexObject(ob)
+
+
+@adapter(IHasLocalGrants, IIntIdRemovedEvent)
+def unindexLocalGrants(ob, event):
+    """Remove objects with grants from the index before losing their id"""
+    index = queryUtility(ILocalGrantIndex)
+    if index is not None:
+        index.unindexObject(ob)
+
+
+def _revokeLocalGrants(ob, principal_ids):
+    # Unset the principal role and principal permission grants of the
+    # principals on an object.
+    changed = 0
+    roles = AnnotationPrincipalRoleManager(ob)
+    cells = [(role_id, principal_id) for principal_id in principal_ids
+             for role_id, setting in roles.iterRolesForPrincipal(principal_id)]
+    if cells:
+        changed += roles.delCells(cells)
+    permissions = AnnotationPrincipalPermissionManager(ob)
+    cells = [(permission_id, principal_id) for principal_id in principal_ids
+             for permission_id, setting
+             in permissions.iterPermissionsForPrincipal(principal_id)]
+    if cells:
+        changed += permissions.delCells(cells)
+    return changed
+
+
+def revokeGrantsForPrincipals(principal_ids, batch_size=1000, progress=None,
+                              start=None, commit=True):
+    """Unset all the roles and permissions granted or denied to principals
+
+    The grants are unset in the global principal role and principal
+    permission managers, and on all objects the `ILocalGrantIndex`
+    utility knows to have grants for the principals.  Objects are taken
+    in the order of their int ids, `batch_size` at a time, and the
+    transaction is committed after every batch unless `commit` is false.
+
+    After every batch, `progress(done, total, checkpoint)` is called, if
+    given, with the number of objects done and to do, and the int id of
+    the last object done.  Passing the checkpoint as `start` continues
+    after the objects done.  Since revoked grants leave the index,
+    simply running again continues as well.
+
+    Return the number of settings that were unset.
+    """
+    index = getUtility(ILocalGrantIndex)
+    intids = getUtility(IIntIds)
+    principal_ids = list(principal_ids)
+
+    changed = 0
+    for principal_id in principal_ids:
+        changed += principalRoleManager.unsetRolesForPrincipals(
+            [role_id for role_id, setting
+             in principalRoleManager.iterRolesForPrincipal(principal_id)],
+            [principal_id])
+        changed += principalPermissionManager.unsetPermissionsForPrincipal(
+            [permission_id for permission_id, setting
+             in principalPermissionManager.iterPermissionsForPrincipal(
+                 principal_id)],
+            principal_id)
+
+    uids = index.family.II.multiunion(
+        [index.getObjectIds('principal', principal_id)
+         for principal_id in principal_ids])
+    if start is not None:
+        uids = index.family.II.Set(uids.keys(start, excludemin=True))
+
+    total = len(uids)
+    done = 0
+    uids = iter(uids)
+    while True:
+        batch = list(itertools.islice(uids, batch_size))
+        if not batch:
+            break
+        with batchedChanges():
+            for uid in batch:
+                ob = intids.queryObject(uid)
+                if ob is not None:
+                    changed += _revokeLocalGrants(ob, principal_ids)
+        if commit:
+            transaction.commit()
+        done += len(batch)
+        if progress is not None:
+            progress(done, total, batch[-1])
+
+    return changed
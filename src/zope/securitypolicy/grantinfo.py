@@ -38,7 +38,6 @@ del AnnotationRolePermissionManager
 class AnnotationGrantInfo:
 
     def __init__(self, context):
-        self._context = context
         annotations = IAnnotations(context, {})
 
         # by principals
@@ -84,6 +84,25 @@ class IPrincipalRoleMap(Interface):
         role id, principal id, and setting, in that order.
         """
 
+    def iterPrincipalsForRole(role_id):
+        """Iterate over the (principal id, setting) tuples of a role.
+
+        Like getPrincipalsForRole, but without building a list.  The
+        settings must not change before the iteration is done.
+        """
+
+    def iterRolesForPrincipal(principal_id):
+        """Iterate over the (role id, setting) tuples of a principal.
+
+        Like getRolesForPrincipal, but without building a list.
+        """
+
+    def iterPrincipalsAndRoles():
+        """Iterate over the (role id, principal id, setting) tuples.
+
+        Like getPrincipalsAndRoles, but without building a list.
+        """
+
 
 class IPrincipalRoleManager(IPrincipalRoleMap):
     """Management interface for mappings between principals and roles."""
@@ -97,6 +116,24 @@ class IPrincipalRoleManager(IPrincipalRoleMap):
     def unsetRoleForPrincipal(role_id, principal_id):
         """Unset the role for the principal."""
 
+    def assignRolesToPrincipals(role_ids, principal_ids):
+        """Assign each of the roles to each of the principals.
+
+        Return the number of settings that changed.
+        """
+
+    def removeRolesFromPrincipals(role_ids, principal_ids):
+        """Remove each of the roles from each of the principals.
+
+        Return the number of settings that changed.
+        """
+
+    def unsetRolesForPrincipals(role_ids, principal_ids):
+        """Unset each of the roles for each of the principals.
+
+        Return the number of settings that were unset.
+        """
+
 
 class IRolePermissionMap(Interface):
     """Mappings between roles and permissions."""
@@ -137,6 +174,25 @@ class IRolePermissionMap(Interface):
         list is returned.
         """
 
+    def iterPermissionsForRole(role_id):
+        """Iterate over the (permission id, setting) tuples of a role.
+
+        Like getPermissionsForRole, but without building a list.  The
+        settings must not change before the iteration is done.
+        """
+
+    def iterRolesForPermission(permission_id):
+        """Iterate over the (role id, setting) tuples of a permission.
+
+        Like getRolesForPermission, but without building a list.
+        """
+
+    def iterRolesAndPermissions():
+        """Iterate over the (permission id, role id, setting) tuples.
+
+        Like getRolesAndPermissions, but without building a list.
+        """
+
 
 class IRolePermissionManager(IRolePermissionMap):
     """Management interface for mappings between roles and permissions."""
@@ -153,6 +209,24 @@ class IRolePermissionManager(IRolePermissionMap):
         """Clear the setting of the permission to the role.
         """
 
+    def grantPermissionsToRole(permission_ids, role_id):
+        """Bind each of the permissions to the role.
+
+        Return the number of settings that changed.
+        """
+
+    def denyPermissionsToRole(permission_ids, role_id):
+        """Deny each of the permissions to the role.
+
+        Return the number of settings that changed.
+        """
+
+    def unsetPermissionsFromRole(permission_ids, role_id):
+        """Clear the settings of the permissions to the role.
+
+        Return the number of settings that were cleared.
+        """
+
 
 class IPrincipalPermissionMap(Interface):
     """Mappings between principals and permissions."""
@@ -192,6 +266,25 @@ class IPrincipalPermissionMap(Interface):
         (permission id, principal id, setting)
         """
 
+    def iterPrincipalsForPermission(permission_id):
+        """Iterate over the (principal id, setting) tuples of a permission.
+
+        Like getPrincipalsForPermission, but without building a list.  The
+        settings must not change before the iteration is done.
+        """
+
+    def iterPermissionsForPrincipal(principal_id):
+        """Iterate over the (permission id, setting) tuples of a principal.
+
+        Like getPermissionsForPrincipal, but without building a list.
+        """
+
+    def iterPrincipalsAndPermissions():
+        """Iterate over the (permission id, principal id, setting) tuples.
+
+        Like getPrincipalsAndPermissions, but without building a list.
+        """
+
 
 class IPrincipalPermissionManager(IPrincipalPermissionMap):
     """Management interface for mappings between principals and permissions."""
@@ -209,6 +302,25 @@ class IPrincipalPermissionManager(IPrincipalPermissionMap):
         principal.
         """
 
+    def grantPermissionsToPrincipal(permission_ids, principal_id):
+        """Allow each of the permissions for the principal.
+
+        Return the number of settings that changed.
+        """
+
+    def denyPermissionsToPrincipal(permission_ids, principal_id):
+        """Deny each of the permissions to the principal.
+
+        Return the number of settings that changed.
+        """
+
+    def unsetPermissionsForPrincipal(permission_ids, principal_id):
+        """Remove the permissions (either denied or allowed) from the
+        principal.
+
+        Return the number of settings that were removed.
+        """
+
 
 class IGrantInfo(Interface):
     """Get grant info needed for checking access
@@ -235,5 +347,47 @@ class IGrantInfo(Interface):
         """
 
 
+class IHasLocalGrants(Interface):
+    """Marker for objects with grants stored in their annotations.
+
+    The annotation security maps provide it on their objects when the
+    first grant is made and take it away when the last one is removed.
+    """
+
+
+class ILocalGrantIndex(Interface):
+    """Index of the objects with local grants.
+
+    It maps principal, role and permission ids to the integer ids of the
+    objects with grants involving them.  The annotation security maps
+    keep a utility providing it up to date as grants change.
+    """
+
+    def update(context, added=(), removed=()):
+        """Record the ids that gained or lost grants on an object.
+
+        `added` and `removed` are iterables of (kind, id) tuples, where the
+        kind is 'principal', 'role' or 'permission'.  Every security map
+        of the object reports the ids it gains or loses, so an id added
+        by several maps is only removed once all of them removed it.
+        """
+
+    def indexObject(context):
+        """Index the grants an object has, replacing what was indexed."""
+
+    def unindexObject(context):
+        """Remove an object from the index."""
+
+    def getObjectIds(kind, id):
+        """Return the ids of the objects with grants involving an id.
+
+        The kind is 'principal', 'role' or 'permission'.  The object ids
+        are returned in ascending order.
+        """
+
+    def getObjects(kind, id):
+        """Iterate over the objects with grants involving an id."""
+
+
 class IGrantVocabulary(Interface):
     """Marker interface for register the RadioWidget."""
@@ -36,6 +36,9 @@ class AnnotationPrincipalPermissionManager(AnnotationSecurityMap):
     # we'll keep it as is, to prevent breaking old data:
     key = 'zopel.app.security.AnnotationPrincipalPermissionManager'
 
+    # Permissions are our rows, and principals are our columns
+    index_kinds = ('permission', 'principal')
+
     def grantPermissionToPrincipal(self, permission_id, principal_id):
         AnnotationSecurityMap.addCell(self, permission_id, principal_id, Allow)
 
@@ -43,6 +46,22 @@ class AnnotationPrincipalPermissionManager(AnnotationSecurityMap):
         AnnotationSecurityMap.addCell(self, permission_id, principal_id, Deny)
 
     unsetPermissionForPrincipal = AnnotationSecurityMap.delCell
+
+    def grantPermissionsToPrincipal(self, permission_ids, principal_id):
+        return AnnotationSecurityMap.addCells(
+            self, [(permission_id, principal_id, Allow)
+                   for permission_id in permission_ids])
+
+    def denyPermissionsToPrincipal(self, permission_ids, principal_id):
+        return AnnotationSecurityMap.addCells(
+            self, [(permission_id, principal_id, Deny)
+                   for permission_id in permission_ids])
+
+    def unsetPermissionsForPrincipal(self, permission_ids, principal_id):
+        return AnnotationSecurityMap.delCells(
+            self, [(permission_id, principal_id)
+                   for permission_id in permission_ids])
+
     getPrincipalsForPermission = AnnotationSecurityMap.getRow
     getPermissionsForPrincipal = AnnotationSecurityMap.getCol
 
@@ -52,6 +71,10 @@ class AnnotationPrincipalPermissionManager(AnnotationSecurityMap):
 
     getPrincipalsAndPermissions = AnnotationSecurityMap.getAllCells
 
+    iterPrincipalsForPermission = AnnotationSecurityMap.iterRow
+    iterPermissionsForPrincipal = AnnotationSecurityMap.iterCol
+    iterPrincipalsAndPermissions = AnnotationSecurityMap.iterAllCells
+
 
 @implementer(IPrincipalPermissionManager)
 class PrincipalPermissionManager(SecurityMap):
@@ -69,8 +92,8 @@ class PrincipalPermissionManager(SecurityMap):
     def grantAllPermissionsToPrincipal(self, principal_id):
         ''' See the interface IPrincipalPermissionManager '''
 
-        for permission_id in allPermissions(None):
-            self.grantPermissionToPrincipal(permission_id, principal_id, False)
+        self.grantPermissionsToPrincipal(
+            allPermissions(None), principal_id, False)
 
     def denyPermissionToPrincipal(self, permission_id, principal_id,
                                   check=True):
@@ -89,6 +112,31 @@ class PrincipalPermissionManager(SecurityMap):
 
         self.delCell(permission_id, principal_id)
 
+    def grantPermissionsToPrincipal(self, permission_ids, principal_id,
+                                    check=True):
+        ''' See the interface IPrincipalPermissionManager '''
+
+        if check:
+            checkPrincipal(None, principal_id)
+
+        return self.addCells([(permission_id, principal_id, Allow)
+                              for permission_id in permission_ids])
+
+    def denyPermissionsToPrincipal(self, permission_ids, principal_id,
+                                   check=True):
+        ''' See the interface IPrincipalPermissionManager '''
+
+        if check:
+            checkPrincipal(None, principal_id)
+
+        return self.addCells([(permission_id, principal_id, Deny)
+                              for permission_id in permission_ids])
+
+    def unsetPermissionsForPrincipal(self, permission_ids, principal_id):
+        ''' See the interface IPrincipalPermissionManager '''
+        return self.delCells([(permission_id, principal_id)
+                              for permission_id in permission_ids])
+
     def getPrincipalsForPermission(self, permission_id):
         ''' See the interface IPrincipalPermissionManager '''
         return self.getRow(permission_id)
@@ -105,6 +153,18 @@ class PrincipalPermissionManager(SecurityMap):
         ''' See the interface IPrincipalPermissionManager '''
         return self.getAllCells()
 
+    def iterPrincipalsForPermission(self, permission_id):
+        ''' See the interface IPrincipalPermissionManager '''
+        return self.iterRow(permission_id)
+
+    def iterPermissionsForPrincipal(self, principal_id):
+        ''' See the interface IPrincipalPermissionManager '''
+        return self.iterCol(principal_id)
+
+    def iterPrincipalsAndPermissions(self):
+        ''' See the interface IPrincipalPermissionManager '''
+        return self.iterAllCells()
+
 
 # Permissions are our rows, and principals are our columns
 principalPermissionManager = PrincipalPermissionManager()
@@ -21,10 +21,19 @@ from zope.securitypolicy.interfaces import Deny
 from zope.securitypolicy.interfaces import IPrincipalRoleManager
 from zope.securitypolicy.interfaces import Unset
 from zope.securitypolicy.role import checkRole
+from zope.securitypolicy.rolemask import roleBit
 from zope.securitypolicy.securitymap import AnnotationSecurityMap
 from zope.securitypolicy.securitymap import SecurityMap
 
 
+def _roleCells(role_ids, principal_ids, *setting):
+    # The (role, principal[, setting]) cells of each of the roles and each
+    # of the principals
+    principal_ids = tuple(principal_ids)
+    return [(role_id, principal_id) + setting
+            for role_id in role_ids for principal_id in principal_ids]
+
+
 @implementer(IPrincipalRoleManager)
 class AnnotationPrincipalRoleManager(AnnotationSecurityMap):
     """Mappings between principals and roles."""
@@ -33,6 +42,9 @@ class AnnotationPrincipalRoleManager(AnnotationSecurityMap):
     # location, but cannot change without breaking existing databases
     key = 'zope.app.security.AnnotationPrincipalRoleManager'
 
+    # Roles are our rows, and principals are our columns
+    index_kinds = ('role', 'principal')
+
     def assignRoleToPrincipal(self, role_id, principal_id):
         AnnotationSecurityMap.addCell(self, role_id, principal_id, Allow)
 
@@ -40,6 +52,19 @@ class AnnotationPrincipalRoleManager(AnnotationSecurityMap):
         AnnotationSecurityMap.addCell(self, role_id, principal_id, Deny)
 
     unsetRoleForPrincipal = AnnotationSecurityMap.delCell
+
+    def assignRolesToPrincipals(self, role_ids, principal_ids):
+        return AnnotationSecurityMap.addCells(
+            self, _roleCells(role_ids, principal_ids, Allow))
+
+    def removeRolesFromPrincipals(self, role_ids, principal_ids):
+        return AnnotationSecurityMap.addCells(
+            self, _roleCells(role_ids, principal_ids, Deny))
+
+    def unsetRolesForPrincipals(self, role_ids, principal_ids):
+        return AnnotationSecurityMap.delCells(
+            self, _roleCells(role_ids, principal_ids))
+
     getPrincipalsForRole = AnnotationSecurityMap.getRow
     getRolesForPrincipal = AnnotationSecurityMap.getCol
 
@@ -49,11 +74,23 @@ class AnnotationPrincipalRoleManager(AnnotationSecurityMap):
 
     getPrincipalsAndRoles = AnnotationSecurityMap.getAllCells
 
+    iterPrincipalsForRole = AnnotationSecurityMap.iterRow
+    iterRolesForPrincipal = AnnotationSecurityMap.iterCol
+    iterPrincipalsAndRoles = AnnotationSecurityMap.iterAllCells
+
 
 @implementer(IPrincipalRoleManager)
 class PrincipalRoleManager(SecurityMap):
     """Mappings between principals and roles."""
 
+    def _clear(self):
+        SecurityMap._clear(self)
+        self._masks = {}
+
+    def _invalidated_interaction_cache(self):
+        self._masks = {}
+        SecurityMap._invalidated_interaction_cache(self)
+
     def assignRoleToPrincipal(self, role_id, principal_id, check=True):
         ''' See the interface IPrincipalRoleManager '''
 
@@ -80,6 +117,31 @@ class PrincipalRoleManager(SecurityMap):
 
         self.delCell(role_id, principal_id)
 
+    def _checkedRoleCells(self, role_ids, principal_ids, setting, check):
+        role_ids = tuple(role_ids)
+        principal_ids = tuple(principal_ids)
+        if check:
+            for principal_id in principal_ids:
+                checkPrincipal(None, principal_id)
+            for role_id in role_ids:
+                checkRole(None, role_id)
+        return _roleCells(role_ids, principal_ids, setting)
+
+    def assignRolesToPrincipals(self, role_ids, principal_ids, check=True):
+        ''' See the interface IPrincipalRoleManager '''
+        return self.addCells(
+            self._checkedRoleCells(role_ids, principal_ids, Allow, check))
+
+    def removeRolesFromPrincipals(self, role_ids, principal_ids,
+                                  check=True):
+        ''' See the interface IPrincipalRoleManager '''
+        return self.addCells(
+            self._checkedRoleCells(role_ids, principal_ids, Deny, check))
+
+    def unsetRolesForPrincipals(self, role_ids, principal_ids):
+        ''' See the interface IPrincipalRoleManager '''
+        return self.delCells(_roleCells(role_ids, principal_ids))
+
     def getPrincipalsForRole(self, role_id):
         ''' See the interface IPrincipalRoleMap '''
         return self.getRow(role_id)
@@ -96,6 +158,38 @@ class PrincipalRoleManager(SecurityMap):
         ''' See the interface IPrincipalRoleMap '''
         return self.getAllCells()
 
+    def iterPrincipalsForRole(self, role_id):
+        ''' See the interface IPrincipalRoleMap '''
+        return self.iterRow(role_id)
+
+    def iterRolesForPrincipal(self, principal_id):
+        ''' See the interface IPrincipalRoleMap '''
+        return self.iterCol(principal_id)
+
+    def iterPrincipalsAndRoles(self):
+        ''' See the interface IPrincipalRoleMap '''
+        return self.iterAllCells()
+
+    def getRoleMasksForPrincipal(self, principal_id):
+        '''Return the masks of the roles assigned to and removed from a
+        principal
+
+        See `zope.securitypolicy.rolemask`.
+        '''
+        masks = self._masks
+        try:
+            return masks[principal_id]
+        except KeyError:
+            pass
+        allowed = denied = 0
+        for role_id, setting in self.iterCol(principal_id):
+            if setting is Allow:
+                allowed |= roleBit(role_id)
+            else:
+                denied |= roleBit(role_id)
+        masks[principal_id] = allowed, denied
+        return allowed, denied
+
 
 # Roles are our rows, and principals are our columns
 principalRoleManager = PrincipalRoleManager()
@@ -15,8 +15,10 @@
 """
 __docformat__ = 'restructuredtext'
 
+import weakref
+
 from persistent import Persistent
-from zope.component import getUtilitiesFor
+from zope.component import getSiteManager
 from zope.i18nmessageid import ZopeMessageFactory as _
 from zope.interface import implementer
 from zope.location import Location
@@ -26,6 +28,11 @@ from zope.securitypolicy.interfaces import IRole
 
 NULL_ID = _('<role not activated>')
 
+# The ids of the roles defined in a site manager, as a tuple and as a
+# frozenset, and the generations of its utility registries they were
+# looked up at, by site manager
+_roleIds = weakref.WeakKeyDictionary()
+
 
 @implementer(IRole)
 class Role:
@@ -101,7 +108,46 @@ def unsetIdOnDeactivation(role, event):
     role.id = NULL_ID
 
 
+def _lookupRoleIds(sm):
+    # Return the cached ids of the roles defined in a site manager.  Any
+    # change to its utility registry or one of their bases, whether it
+    # was made here, without events or by another ZODB client, changes
+    # their generations, after which the ids are looked up again.
+    utilities = getattr(sm, 'utilities', None)
+    generations = None
+    if utilities is not None:
+        generations = tuple(r._generation for r in utilities.ro)
+        cached = _roleIds.get(sm)
+        if cached is not None and cached[0] == generations:
+            return cached
+    ids = tuple(name for name, util in sm.getUtilitiesFor(IRole))
+    cached = generations, ids, frozenset(ids)
+    if generations is not None:
+        _roleIds[sm] = cached
+    return cached
+
+
+def getRoleIds(context):
+    """Return the ids of the roles defined for a context, as a tuple.
+
+    The tuple is shared until the roles defined change.
+    """
+    return _lookupRoleIds(getSiteManager(context))[1]
+
+
 def checkRole(context, role_id):
-    names = [name for name, util in getUtilitiesFor(IRole, context)]
-    if role_id not in names:
+    """Raise a ValueError if no role with the id is defined.
+    """
+    if role_id not in _lookupRoleIds(getSiteManager(context))[2]:
         raise ValueError("Undefined role id", role_id)
+
+
+# Register our cleanup with Testing.CleanUp to make writing unit tests
+# simpler.
+try:
+    from zope.testing.cleanup import addCleanUp
+except ModuleNotFoundError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(_roleIds.clear)
+    del addCleanUp
@@ -0,0 +1,51 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Role masks
+
+Sets of roles can be represented as integers in which every role id has
+its own bit.  Whether two sets of roles intersect is then a single `&`.
+
+  >>> from zope.securitypolicy.rolemask import roleBit, roleMask
+  >>> roleBit('zope.Manager') == roleBit('zope.Manager')
+  True
+  >>> roleBit('zope.Manager') & roleBit('zope.Member')
+  0
+  >>> roleMask(['zope.Manager', 'zope.Member']) & roleBit('zope.Member') != 0
+  True
+
+Bits are assigned as role ids are first seen and never reused, so masks
+can be kept for the life of the process.
+"""
+import threading
+
+
+_bits = {}
+_lock = threading.Lock()
+
+
+def roleBit(role_id):
+    """Return the bit standing for a role id."""
+    try:
+        return _bits[role_id]
+    except KeyError:
+        with _lock:
+            return _bits.setdefault(role_id, 1 << len(_bits))
+
+
+def roleMask(role_ids):
+    """Return the mask of an iterable of role ids."""
+    mask = 0
+    for role_id in role_ids:
+        mask |= roleBit(role_id)
+    return mask
@@ -21,6 +21,7 @@ from zope.securitypolicy.interfaces import Deny
 from zope.securitypolicy.interfaces import IRolePermissionManager
 from zope.securitypolicy.interfaces import Unset
 from zope.securitypolicy.role import checkRole
+from zope.securitypolicy.rolemask import roleMask
 from zope.securitypolicy.securitymap import AnnotationSecurityMap
 from zope.securitypolicy.securitymap import SecurityMap
 
@@ -34,6 +35,9 @@ class AnnotationRolePermissionManager(AnnotationSecurityMap):
     # location, but cannot change without breaking existing databases
     key = 'zope.app.security.AnnotationRolePermissionManager'
 
+    # Permissions are our rows, and roles are our columns
+    index_kinds = ('permission', 'role')
+
     def grantPermissionToRole(self, permission_id, role_id):
         AnnotationSecurityMap.addCell(self, permission_id, role_id, Allow)
 
@@ -41,10 +45,30 @@ class AnnotationRolePermissionManager(AnnotationSecurityMap):
         AnnotationSecurityMap.addCell(self, permission_id, role_id, Deny)
 
     unsetPermissionFromRole = AnnotationSecurityMap.delCell
+
+    def grantPermissionsToRole(self, permission_ids, role_id):
+        return AnnotationSecurityMap.addCells(
+            self, [(permission_id, role_id, Allow)
+                   for permission_id in permission_ids])
+
+    def denyPermissionsToRole(self, permission_ids, role_id):
+        return AnnotationSecurityMap.addCells(
+            self, [(permission_id, role_id, Deny)
+                   for permission_id in permission_ids])
+
+    def unsetPermissionsFromRole(self, permission_ids, role_id):
+        return AnnotationSecurityMap.delCells(
+            self, [(permission_id, role_id)
+                   for permission_id in permission_ids])
+
     getRolesForPermission = AnnotationSecurityMap.getRow
     getPermissionsForRole = AnnotationSecurityMap.getCol
     getRolesAndPermissions = AnnotationSecurityMap.getAllCells
 
+    iterRolesForPermission = AnnotationSecurityMap.iterRow
+    iterPermissionsForRole = AnnotationSecurityMap.iterCol
+    iterRolesAndPermissions = AnnotationSecurityMap.iterAllCells
+
     def getSetting(self, permission_id, role_id, default=Unset):
         return AnnotationSecurityMap.queryCell(
             self, permission_id, role_id, default)
@@ -54,6 +78,14 @@ class AnnotationRolePermissionManager(AnnotationSecurityMap):
 class RolePermissionManager(SecurityMap):
     """Mappings between roles and permissions."""
 
+    def _clear(self):
+        SecurityMap._clear(self)
+        self._masks = {}
+
+    def _invalidated_interaction_cache(self):
+        self._masks = {}
+        SecurityMap._invalidated_interaction_cache(self)
+
     def grantPermissionToRole(self, permission_id, role_id, check=True):
         '''See interface IRolePermissionMap'''
 
@@ -63,8 +95,7 @@ class RolePermissionManager(SecurityMap):
         self.addCell(permission_id, role_id, Allow)
 
     def grantAllPermissionsToRole(self, role_id):
-        for permission_id in allPermissions(None):
-            self.grantPermissionToRole(permission_id, role_id, False)
+        self.grantPermissionsToRole(allPermissions(None), role_id, False)
 
     def denyPermissionToRole(self, permission_id, role_id, check=True):
         '''See interface IRolePermissionMap'''
@@ -82,6 +113,29 @@ class RolePermissionManager(SecurityMap):
 
         self.delCell(permission_id, role_id)
 
+    def grantPermissionsToRole(self, permission_ids, role_id, check=True):
+        '''See interface IRolePermissionManager'''
+
+        if check:
+            checkRole(None, role_id)
+
+        return self.addCells([(permission_id, role_id, Allow)
+                              for permission_id in permission_ids])
+
+    def denyPermissionsToRole(self, permission_ids, role_id, check=True):
+        '''See interface IRolePermissionManager'''
+
+        if check:
+            checkRole(None, role_id)
+
+        return self.addCells([(permission_id, role_id, Deny)
+                              for permission_id in permission_ids])
+
+    def unsetPermissionsFromRole(self, permission_ids, role_id):
+        '''See interface IRolePermissionManager'''
+        return self.delCells([(permission_id, role_id)
+                              for permission_id in permission_ids])
+
     def getRolesForPermission(self, permission_id):
         '''See interface IRolePermissionMap'''
         return self.getRow(permission_id)
@@ -98,6 +152,33 @@ class RolePermissionManager(SecurityMap):
         '''See interface IRolePermissionMap'''
         return self.getAllCells()
 
+    def iterRolesForPermission(self, permission_id):
+        '''See interface IRolePermissionMap'''
+        return self.iterRow(permission_id)
+
+    def iterPermissionsForRole(self, role_id):
+        '''See interface IRolePermissionMap'''
+        return self.iterCol(role_id)
+
+    def iterRolesAndPermissions(self):
+        '''See interface IRolePermissionMap'''
+        return self.iterAllCells()
+
+    def getRoleMaskForPermission(self, permission_id):
+        '''Return the mask of the roles granted a permission
+
+        See `zope.securitypolicy.rolemask`.
+        '''
+        masks = self._masks
+        try:
+            return masks[permission_id]
+        except KeyError:
+            pass
+        mask = masks[permission_id] = roleMask(
+            role_id for role_id, setting in self.iterRow(permission_id)
+            if setting is Allow)
+        return mask
+
 
 # Permissions are our rows, and roles are our columns
 rolePermissionManager = RolePermissionManager()
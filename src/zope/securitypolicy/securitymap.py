@@ -13,13 +13,202 @@
 ##############################################################################
 """Generic two-dimensional array type (in context of security)
 """
+import contextlib
+import itertools
+import sys
+import threading
+
 from persistent import Persistent
 from zope.annotation import IAnnotations
+from zope.component import queryUtility
+from zope.interface import alsoProvides
+from zope.interface import directlyProvidedBy
+from zope.interface import noLongerProvides
 from zope.security.management import queryInteraction
 
+from zope.securitypolicy.interfaces import IHasLocalGrants
+from zope.securitypolicy.interfaces import ILocalGrantIndex
+
+
+try:
+    from BTrees.OOBTree import OOBTree
+except ModuleNotFoundError:  # pragma: no cover
+    OOBTree = None
+
+try:
+    import transaction
+    from transaction.interfaces import NoTransaction
+except ModuleNotFoundError:  # pragma: no cover
+    transaction = None
+
+
+# Every change to any security map bumps the grant generation, so that
+# caches living longer than an interaction can tell when they are stale.
+_generations = itertools.count(1)
+_generation = next(_generations)
+
+
+def getGeneration():
+    """Return the current grant generation.
+
+    The value changes whenever a cell is added to or removed from any
+    security map in this process, and again when a transaction that
+    changed grants commits or aborts.
+    """
+    return _generation
+
+
+def _bumpGeneration(*args):
+    global _generation
+    _generation = next(_generations)
+
+
+def _currentTransaction():
+    if transaction is None:  # pragma: no cover
+        return None
+    try:
+        return transaction.get()
+    except NoTransaction:  # pragma: no cover
+        return None
+
+
+def _grantsChanged():
+    _bumpGeneration()
+    # Other threads may have computed decisions from their snapshot
+    # of the database while our changes were pending, and we may have
+    # computed some from changes that are then aborted, so we bump the
+    # generation again once the transaction ends.
+    txn = _currentTransaction()
+    if txn is None:
+        return
+    try:
+        txn.data(_bumpGeneration)
+    except KeyError:
+        txn.set_data(_bumpGeneration, True)
+        txn.addAfterCommitHook(_bumpGeneration)
+        txn.addAfterAbortHook(_bumpGeneration)
+
+
+def hasPendingChanges():
+    """Return whether the current transaction changed grants.
+
+    Decisions made while it has must not be shared with other threads,
+    as the changes may still be aborted and aren't visible to them yet.
+    """
+    txn = _currentTransaction()
+    if txn is None:
+        return False
+    try:
+        txn.data(_bumpGeneration)
+    except KeyError:
+        return False
+    return True
+
+
+# The changes of the batchedChanges block a thread is in, if any
+_batch = threading.local()
+
+
+class _Batch:
+
+    # The transaction we flush the batch before the commit of
+    txn = None
+
+    def __init__(self):
+        # The objects whose grants changed, by id
+        self.contexts = {}
+
+    def flush(self):
+        # Invalidate for the changes made so far
+        contexts = list(self.contexts.values())
+        self.contexts.clear()
+        if contexts:
+            _invalidateInteraction(
+                contexts[0] if len(contexts) == 1 else None)
+
+    def flushBeforeCommit(self):
+        # Make sure that the caches are invalidated for the changes
+        # committed with the current transaction, if it commits within
+        # the block.
+        txn = _currentTransaction()
+        if txn is None:
+            return
+        if txn is not self.txn:
+            self.txn = txn
+            txn.addBeforeCommitHook(self.flush)
+
+
+@contextlib.contextmanager
+def batchedChanges():
+    """Defer cache invalidation for the security map changes in a block.
+
+    Within the block, changing grants does not invalidate the cache of
+    the current interaction for every change; that happens once when the
+    block is left, or before the current transaction commits if the
+    block commits it.  If grants changed on more than one object, the
+    whole interaction cache is invalidated.  Blocks may be nested; the
+    outermost one invalidates.  Security checks made within the block
+    by the current interaction may not see its changes yet.  The grant
+    generation still changes with every change.
+    """
+    if getattr(_batch, 'current', None) is not None:
+        yield
+        return
+    batch = _batch.current = _Batch()
+    try:
+        yield
+    finally:
+        _batch.current = None
+        batch.flush()
+
+
+def _invalidateInteraction(context):
+    # Invalidate this threads interaction cache, preferably only for
+    # the objects affected by our grants.
+    interaction = queryInteraction()
+    if interaction is not None:
+        invalidate_cache_for = getattr(
+            interaction, 'invalidate_cache_for', None)
+        if invalidate_cache_for is not None:
+            invalidate_cache_for(context)
+            return
+        try:
+            invalidate_cache = interaction.invalidate_cache
+        except AttributeError:
+            pass
+        else:
+            invalidate_cache()
+
+
+def internId(id):
+    """Return the canonical instance of a principal, role or permission id.
+
+    The same ids are stored in many maps and caches.  Interning them lets
+    equal ids share one object, which saves memory and makes comparing
+    them cheap.  Ids that aren't strings are returned as they are.
+    """
+    if type(id) is str:
+        return sys.intern(id)
+    return id
+
+
+def _internIds(mapping):
+    # Intern the keys of a two-level mapping as stored by SecurityMap
+    return {internId(key): {internId(k): v for k, v in value.items()}
+            for key, value in mapping.items()}
+
+
+def _toBTrees(mapping):
+    # Copy a two-level mapping as stored by SecurityMap into BTrees
+    return OOBTree({key: OOBTree(value) for key, value in mapping.items()})
+
 
 class SecurityMap:
 
+    # The object our grants apply to; None stands for global grants,
+    # which apply to all objects.
+    _context = None
+
     def __init__(self):
         self._clear()
 
@@ -27,12 +216,40 @@ class SecurityMap:
         self._byrow = {}
         self._bycol = {}
 
+    def _newMapping(self):
+        # Rows and columns are stored in the same kind of mapping as the
+        # map stores them in.
+        return self._byrow.__class__()
+
     def __nonzero__(self):
         return bool(self._byrow)
 
     __bool__ = __nonzero__
 
     def addCell(self, rowentry, colentry, value):
+        if self._addCell(rowentry, colentry, value):
+            self._invalidated_interaction_cache()
+            return True
+        return False
+
+    def addCells(self, cells):
+        """Add many (row, column, value) cells at once.
+
+        Caches are invalidated once for all of them.  Return the number
+        of cells that changed.
+        """
+        changed = 0
+        for rowentry, colentry, value in cells:
+            if self._addCell(rowentry, colentry, value):
+                changed += 1
+        if changed:
+            self._invalidated_interaction_cache()
+        return changed
+
+    def _addCell(self, rowentry, colentry, value):
+        rowentry = internId(rowentry)
+        colentry = internId(colentry)
+
         # setdefault may get expensive if an empty mapping is
         # expensive to create, for PersistentDict for instance.
         row = self._byrow.get(rowentry)
@@ -40,31 +257,47 @@ class SecurityMap:
             if row.get(colentry) is value:
                 return False
         else:
-            row = self._byrow[rowentry] = {}
+            row = self._byrow[rowentry] = self._newMapping()
 
         col = self._bycol.get(colentry)
         if not col:
-            col = self._bycol[colentry] = {}
+            col = self._bycol[colentry] = self._newMapping()
 
         row[colentry] = value
         col[rowentry] = value
 
-        self._invalidated_interaction_cache()
-
         return True
 
     def _invalidated_interaction_cache(self):
-        # Invalidate this threads interaction cache
-        interaction = queryInteraction()
-        if interaction is not None:
-            try:
-                invalidate_cache = interaction.invalidate_cache
-            except AttributeError:
-                pass
-            else:
-                invalidate_cache()
+        _grantsChanged()
+        batch = getattr(_batch, 'current', None)
+        if batch is None:
+            _invalidateInteraction(self._context)
+        else:
+            batch.contexts[id(self._context)] = self._context
+            batch.flushBeforeCommit()
 
     def delCell(self, rowentry, colentry):
+        if self._delCell(rowentry, colentry):
+            self._invalidated_interaction_cache()
+            return True
+        return False
+
+    def delCells(self, cells):
+        """Remove many (row, column) cells at once.
+
+        Caches are invalidated once for all of them.  Return the number
+        of cells that were removed.
+        """
+        changed = 0
+        for rowentry, colentry in cells:
+            if self._delCell(rowentry, colentry):
+                changed += 1
+        if changed:
+            self._invalidated_interaction_cache()
+        return changed
+
+    def _delCell(self, rowentry, colentry):
         row = self._byrow.get(rowentry)
         if row and (colentry in row):
             del row[colentry]
@@ -74,9 +307,6 @@ class SecurityMap:
             del col[rowentry]
             if not col:
                 del self._bycol[colentry]
-
-            self._invalidated_interaction_cache()
-
             return True
 
         return False
@@ -95,41 +325,226 @@ class SecurityMap:
             raise KeyError('Not a valid row and column pair.')
         return cell
 
-    def getRow(self, rowentry):
+    def iterRow(self, rowentry):
+        """Iterate over the (column, value) pairs of a row.
+
+        The pairs are taken from the map as it is iterated, so the map
+        must not change before the iteration is done.
+        """
         row = self._byrow.get(rowentry)
         if row:
-            return list(row.items())
-        else:
-            return []
+            return iter(row.items())
+        return iter(())
 
-    def getCol(self, colentry):
+    def iterCol(self, colentry):
+        """Iterate over the (row, value) pairs of a column.
+
+        The map must not change before the iteration is done.
+        """
         col = self._bycol.get(colentry)
         if col:
-            return list(col.items())
-        else:
-            return []
+            return iter(col.items())
+        return iter(())
+
+    def iterAllCells(self):
+        """Iterate over the (row, column, value) cells of the map.
+
+        The map must not change before the iteration is done.
+        """
+        for r, row in self._byrow.items():
+            for c, value in row.items():
+                yield r, c, value
+
+    def getRow(self, rowentry):
+        return list(self.iterRow(rowentry))
+
+    def getCol(self, colentry):
+        return list(self.iterCol(colentry))
 
     def getAllCells(self):
-        res = []
-        for r in self._byrow.keys():
-            for c in self._byrow[r].items():
-                res.append((r,) + c)
-        return res
+        return list(self.iterAllCells())
 
 
 class PersistentSecurityMap(SecurityMap, Persistent):
 
+    # Maps with at least this many rows and columns are moved into BTrees
+    # the next time they change, so that changing a cell only writes the
+    # buckets it is in instead of the whole map.  None keeps all maps in
+    # dictionaries.  This requires the BTrees package.
+    btree_threshold = None
+
+    # Whether only the rows are stored.  The columns are then derived from
+    # them, into a volatile attribute, when they are first needed after
+    # the map was loaded, which halves what is stored for most maps.
+    rows_only = False
+
+    def _migrate(self):
+        # Move the cells into BTrees if the map outgrew btree_threshold.
+        # Return whether the map is stored in BTrees.
+        if not isinstance(self._byrow, dict):
+            return True
+        threshold = self.btree_threshold
+        if (threshold is None or OOBTree is None
+                or len(self._byrow) + len(self._bycol) < threshold):
+            return False
+        self._byrow = _toBTrees(self._byrow)
+        self._bycol = _toBTrees(self._bycol)
+        return True
+
+    def __setstate__(self, state):
+        # Pickles only share ids within one record, so we intern them
+        # when loading.
+        state = dict(state)
+        for name in ('_byrow', '_bycol'):
+            if isinstance(state.get(name), dict):
+                state[name] = _internIds(state[name])
+        Persistent.__setstate__(self, state)
+
+    def __getstate__(self):
+        state = Persistent.__getstate__(self)
+        if self.rows_only:
+            if '_bycol' in state:
+                state = dict(state)
+                del state['_bycol']
+        elif '_bycol' not in state:
+            state = dict(state, _bycol=self._bycol)
+        return state
+
+    def __getattr__(self, name):
+        # Only called for attributes we don't have, which means that we
+        # were loaded with rows only.
+        if name != '_bycol':
+            raise AttributeError(name)
+        try:
+            return self._v_bycol
+        except AttributeError:
+            pass
+        bycol = {}
+        for rowentry, row in self._byrow.items():
+            for colentry, value in row.items():
+                col = bycol.get(colentry)
+                if col is None:
+                    col = bycol[colentry] = {}
+                col[rowentry] = value
+        self._v_bycol = bycol
+        return bycol
+
     def addCell(self, rowentry, colentry, value):
+        btrees = self._migrate()
         if SecurityMap.addCell(self, rowentry, colentry, value):
-            self._p_changed = 1
+            if not btrees:
+                self._p_changed = 1
 
     def delCell(self, rowentry, colentry):
+        btrees = self._migrate()
         if SecurityMap.delCell(self, rowentry, colentry):
+            if not btrees:
+                self._p_changed = 1
+
+    def addCells(self, cells):
+        btrees = self._migrate()
+        changed = SecurityMap.addCells(self, cells)
+        if changed and not btrees:
+            self._p_changed = 1
+        return changed
+
+    def delCells(self, cells):
+        btrees = self._migrate()
+        changed = SecurityMap.delCells(self, cells)
+        if changed and not btrees:
             self._p_changed = 1
+        return changed
+
+
+# The annotation security map classes, by annotation key
+_annotationKeys = {}
+
+
+def hasLocalGrants(context):
+    """Return whether any annotation security map of an object has grants.
+    """
+    annotations = IAnnotations(context, None)
+    if annotations:
+        for key in _annotationKeys:
+            map = annotations.get(key)
+            if map is not None and map._byrow:
+                return True
+    return False
+
+
+def canMarkLocalGrants(context):
+    """Return whether an object can be marked as providing `IHasLocalGrants`.
+
+    Interfaces can't be declared for objects without an instance
+    dictionary, such as those with __slots__.  Their grants work all the
+    same, but they have to be looked at whether they are marked or not.
+    """
+    return getattr(context, '__dict__', None) is not None
+
+
+def _setLocalGrantsMarker(context, marked):
+    if not canMarkLocalGrants(context):
+        return
+    try:
+        if marked:
+            if not IHasLocalGrants.providedBy(context):
+                alsoProvides(context, IHasLocalGrants)
+        elif IHasLocalGrants in directlyProvidedBy(context):
+            noLongerProvides(context, IHasLocalGrants)
+    except (TypeError, AttributeError):
+        pass
+
+
+def updateLocalGrantsMarker(context):
+    """Make an object provide `IHasLocalGrants` exactly if it has grants.
+
+    The annotation security maps maintain the marker themselves; this is
+    for objects whose grants were made before they did.  Return whether
+    the object has grants.
+    """
+    marked = hasLocalGrants(context)
+    _setLocalGrantsMarker(context, marked)
+    return marked
+
+
+def localGrantIds(context):
+    """Iterate over the ids involved in the grants of an object.
+
+    Yield a (kind, id) tuple for every row and column of the annotation
+    security maps of the object that set `index_kinds`, as they are
+    reported to `ILocalGrantIndex`.
+    """
+    annotations = IAnnotations(context, None)
+    if not annotations:
+        return
+    for key, cls in _annotationKeys.items():
+        kinds = cls.index_kinds
+        map = annotations.get(key)
+        if kinds is None or map is None:
+            continue
+        for rowentry in map._byrow:
+            yield kinds[0], rowentry
+        for colentry in map._bycol:
+            yield kinds[1], colentry
 
 
 class AnnotationSecurityMap(SecurityMap):
 
+    # The kinds ('principal', 'role' or 'permission') of the ids of our
+    # rows and columns, which ILocalGrantIndex is told about; None if
+    # they aren't indexed.
+    index_kinds = None
+
+    # The (kind, id) tuples that gained and lost grants during a change,
+    # when there is an index to update.
+    _added = _removed = None
+
+    def __init_subclass__(cls, **kw):
+        super().__init_subclass__(**kw)
+        key = cls.__dict__.get('key')
+        if key is not None:
+            _annotationKeys[key] = cls
+
     def __init__(self, context):
         self.__parent__ = context
         self._context = context
@@ -139,14 +554,28 @@ class AnnotationSecurityMap(SecurityMap):
             self._byrow = {}
             self._bycol = {}
         else:
+            # The columns are only looked up when needed (see __getattr__),
+            # as the map may have to derive them from its rows.
             self._byrow = map._byrow
-            self._bycol = map._bycol
         self.map = map
 
+    def __getattr__(self, name):
+        if name != '_bycol' or 'map' not in self.__dict__:
+            raise AttributeError(name)
+        return self.map._bycol
+
+    def _migrate(self):
+        map = self.map
+        if map is not None and map._migrate():
+            self._byrow = map._byrow
+            self._bycol = map._bycol
+
     def _changed(self):
         map = self.map
         if isinstance(map, PersistentSecurityMap):
-            map._p_changed = 1
+            # BTrees keep track of their changes themselves
+            if isinstance(map._byrow, dict):
+                map._p_changed = 1
         else:
             map = self.map = PersistentSecurityMap()
             map._byrow = self._byrow
@@ -154,10 +583,92 @@ class AnnotationSecurityMap(SecurityMap):
             annotations = IAnnotations(self._context)
             annotations[self.key] = map
 
+    def _beginIndexing(self):
+        # Return the index to tell about the ids gaining or losing grants
+        # in the change we are about to make, if there is one.
+        if self.index_kinds is None:
+            return None
+        index = queryUtility(ILocalGrantIndex)
+        if index is not None:
+            self._added = []
+            self._removed = []
+        return index
+
+    def _endIndexing(self, index):
+        if index is None:
+            return
+        added, removed = self._added, self._removed
+        del self._added, self._removed
+        if added or removed:
+            index.update(self._context, added, removed)
+
+    def _addCell(self, rowentry, colentry, value):
+        added = self._added
+        if added is None:
+            return SecurityMap._addCell(self, rowentry, colentry, value)
+        newrow = rowentry not in self._byrow
+        newcol = colentry not in self._bycol
+        if not SecurityMap._addCell(self, rowentry, colentry, value):
+            return False
+        if newrow:
+            added.append((self.index_kinds[0], internId(rowentry)))
+        if newcol:
+            added.append((self.index_kinds[1], internId(colentry)))
+        return True
+
+    def _delCell(self, rowentry, colentry):
+        if not SecurityMap._delCell(self, rowentry, colentry):
+            return False
+        removed = self._removed
+        if removed is not None:
+            if rowentry not in self._byrow:
+                removed.append((self.index_kinds[0], rowentry))
+            if colentry not in self._bycol:
+                removed.append((self.index_kinds[1], colentry))
+        return True
+
     def addCell(self, rowentry, colentry, value):
-        if SecurityMap.addCell(self, rowentry, colentry, value):
-            self._changed()
+        self._migrate()
+        index = self._beginIndexing()
+        try:
+            if SecurityMap.addCell(self, rowentry, colentry, value):
+                self._changed()
+                _setLocalGrantsMarker(self._context, True)
+        finally:
+            self._endIndexing(index)
 
     def delCell(self, rowentry, colentry):
-        if SecurityMap.delCell(self, rowentry, colentry):
-            self._changed()
+        self._migrate()
+        index = self._beginIndexing()
+        try:
+            if SecurityMap.delCell(self, rowentry, colentry):
+                self._changed()
+                if not self._byrow:
+                    updateLocalGrantsMarker(self._context)
+        finally:
+            self._endIndexing(index)
+
+    def addCells(self, cells):
+        self._migrate()
+        index = self._beginIndexing()
+        try:
+            changed = SecurityMap.addCells(self, cells)
+            if changed:
+                self._changed()
+                _setLocalGrantsMarker(self._context, True)
+        finally:
+            self._endIndexing(index)
+        return changed
+
+    def delCells(self, cells):
+        self._migrate()
+        index = self._beginIndexing()
+        try:
+            changed = SecurityMap.delCells(self, cells)
+            if changed:
+                self._changed()
+                if not self._byrow:
+                    updateLocalGrantsMarker(self._context)
+        finally:
+            self._endIndexing(index)
+        return changed
@@ -147,3 +147,20 @@ class Test(PlacelessSetup, unittest.TestCase):
         self.assertEqual(len(principals), 2)
         self.assertIn((prin1, Allow), principals)
         self.assertIn((prin2, Deny), principals)
+
+    def testBulk(self):
+        from zope.securitypolicy.interfaces import IHasLocalGrants
+        ob = Manageable()
+        manager = AnnotationPrincipalPermissionManager(ob)
+        principal = self._make_principal()
+        self.assertEqual(
+            manager.grantPermissionsToPrincipal(['P1', 'P2'], principal), 2)
+        self.assertTrue(IHasLocalGrants.providedBy(ob))
+        self.assertEqual(
+            manager.denyPermissionsToPrincipal(['P2'], principal), 1)
+        self.assertEqual(manager.getPermissionsForPrincipal(principal),
+                         [('P1', Allow), ('P2', Deny)])
+        self.assertEqual(
+            manager.unsetPermissionsForPrincipal(['P1', 'P2'], principal), 2)
+        self.assertEqual(manager.getPrincipalsAndPermissions(), [])
+        self.assertFalse(IHasLocalGrants.providedBy(ob))
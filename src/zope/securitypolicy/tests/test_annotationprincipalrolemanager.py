@@ -142,3 +142,39 @@ class Test(PlacelessSetup, unittest.TestCase):
         self.assertIn((role1, prin1, Allow), principalsAndRoles)
         self.assertIn((role1, prin2, Allow), principalsAndRoles)
         self.assertIn((role2, prin1, Allow), principalsAndRoles)
+
+    def testIter(self):
+        principalRoleManager = self._make_roleManager()
+        role1 = defineRole('Role One', 'Role #1').id
+        prin1 = self._make_principal()
+        self.assertEqual(list(principalRoleManager.iterPrincipalsAndRoles()),
+                         [])
+        principalRoleManager.assignRoleToPrincipal(role1, prin1)
+        self.assertEqual(
+            list(principalRoleManager.iterPrincipalsForRole(role1)),
+            [(prin1, Allow)])
+        self.assertEqual(
+            list(principalRoleManager.iterRolesForPrincipal(prin1)),
+            [(role1, Allow)])
+        self.assertEqual(list(principalRoleManager.iterPrincipalsAndRoles()),
+                         [(role1, prin1, Allow)])
+
+    def testBulk(self):
+        principalRoleManager = self._make_roleManager()
+        role1 = defineRole('Role One', 'Role #1').id
+        role2 = defineRole('Role Two', 'Role #2').id
+        prin1 = self._make_principal()
+        prin2 = self._make_principal('Principal 2', 'Principal Two')
+        self.assertEqual(
+            principalRoleManager.assignRolesToPrincipals(
+                iter([role1, role2]), iter([prin1, prin2])), 4)
+        self.assertEqual(
+            principalRoleManager.removeRolesFromPrincipals([role1], [prin2]),
+            1)
+        self.assertEqual(principalRoleManager.getSetting(role1, prin2), Deny)
+        self.assertEqual(
+            principalRoleManager.unsetRolesForPrincipals(
+                [role1, role2], [prin1]), 2)
+        self.assertEqual(
+            sorted(principalRoleManager.getPrincipalsAndRoles()),
+            [(role1, prin2, Deny), (role2, prin2, Allow)])
@@ -93,3 +93,18 @@ class Test(PlacelessSetup, unittest.TestCase):
 
         self.assertEqual(mgr.getSetting(self.read, self.peon), Unset)
         self.assertEqual(mgr.getSetting(self.read, self.peon, 1), 1)
+
+    def testBulk(self):
+        mgr = AnnotationRolePermissionManager(Manageable())
+        self.assertEqual(
+            mgr.grantPermissionsToRole([self.read, self.write], self.peon), 2)
+        self.assertEqual(
+            mgr.grantPermissionsToRole([self.read, self.write], self.peon), 0)
+        self.assertEqual(mgr.denyPermissionsToRole([self.write], self.peon),
+                         1)
+        self.assertEqual(list(mgr.getPermissionsForRole(self.peon)),
+                         [(self.read, Allow), (self.write, Deny)])
+        self.assertEqual(
+            mgr.unsetPermissionsFromRole([self.read, self.write], self.peon),
+            2)
+        self.assertEqual(list(mgr.getRolesAndPermissions()), [])
@@ -0,0 +1,228 @@
+##############################################################################
+#
+# Copyright (c) 2026 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Tests for the index of local grants.
+"""
+import unittest
+
+import zope.component
+from zope.annotation.attribute import AttributeAnnotations
+from zope.annotation.interfaces import IAttributeAnnotatable
+from zope.component.testing import PlacelessSetup
+from zope.interface import implementer
+from zope.intid.interfaces import IIntIds
+
+from zope.securitypolicy.grantindex import LocalGrantIndex
+from zope.securitypolicy.grantindex import indexLocalGrants
+from zope.securitypolicy.grantindex import revokeGrantsForPrincipals
+from zope.securitypolicy.grantindex import unindexLocalGrants
+from zope.securitypolicy.interfaces import Allow
+from zope.securitypolicy.interfaces import ILocalGrantIndex
+from zope.securitypolicy.principalpermission import \
+    AnnotationPrincipalPermissionManager
+from zope.securitypolicy.principalpermission import principalPermissionManager
+from zope.securitypolicy.principalrole import AnnotationPrincipalRoleManager
+from zope.securitypolicy.principalrole import principalRoleManager
+from zope.securitypolicy.rolepermission import AnnotationRolePermissionManager
+
+
+@implementer(IAttributeAnnotatable)
+class Manageable:
+    pass
+
+
+@implementer(IIntIds)
+class IntIdsStub:
+
+    def __init__(self):
+        self.ids = {}
+        self.objects = {}
+
+    def register(self, ob):
+        uid = self.ids[id(ob)] = len(self.objects) + 1
+        self.objects[uid] = ob
+        return uid
+
+    def unregister(self, ob):
+        del self.objects[self.ids.pop(id(ob))]
+
+    def queryId(self, ob, default=None):
+        return self.ids.get(id(ob), default)
+
+    def queryObject(self, uid, default=None):
+        return self.objects.get(uid, default)
+
+
+class TestLocalGrantIndex(PlacelessSetup, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        zope.component.provideAdapter(AttributeAnnotations)
+        self.intids = IntIdsStub()
+        zope.component.provideUtility(self.intids, IIntIds)
+        self.index = LocalGrantIndex()
+        zope.component.provideUtility(self.index, ILocalGrantIndex)
+        self.ob1 = Manageable()
+        self.ob2 = Manageable()
+        self.uid1 = self.intids.register(self.ob1)
+        self.uid2 = self.intids.register(self.ob2)
+
+    def _ids(self, kind, id):
+        return list(self.index.getObjectIds(kind, id))
+
+    def test_maintained_by_maps(self):
+        AnnotationPrincipalRoleManager(self.ob1).assignRoleToPrincipal(
+            'R1', 'bob')
+        AnnotationPrincipalRoleManager(self.ob2).assignRolesToPrincipals(
+            ['R1', 'R2'], ['bob'])
+        AnnotationRolePermissionManager(self.ob2).grantPermissionToRole(
+            'P1', 'R3')
+        self.assertEqual(self._ids('principal', 'bob'),
+                         [self.uid1, self.uid2])
+        self.assertEqual(self._ids('role', 'R1'), [self.uid1, self.uid2])
+        self.assertEqual(self._ids('role', 'R2'), [self.uid2])
+        self.assertEqual(self._ids('role', 'R3'), [self.uid2])
+        self.assertEqual(self._ids('permission', 'P1'), [self.uid2])
+        self.assertEqual(list(self.index.getObjects('role', 'R2')),
+                         [self.ob2])
+
+        manager = AnnotationPrincipalRoleManager(self.ob2)
+        manager.unsetRoleForPrincipal('R1', 'bob')
+        self.assertEqual(self._ids('principal', 'bob'),
+                         [self.uid1, self.uid2])
+        self.assertEqual(self._ids('role', 'R1'), [self.uid1])
+        manager.unsetRolesForPrincipals(['R2'], ['bob'])
+        self.assertEqual(self._ids('principal', 'bob'), [self.uid1])
+        self.assertEqual(self._ids('role', 'R2'), [])
+        # R3 is still involved in a role permission grant
+        self.assertEqual(self._ids('role', 'R3'), [self.uid2])
+
+    def test_several_maps_of_an_object(self):
+        AnnotationPrincipalRoleManager(self.ob1).assignRoleToPrincipal(
+            'R1', 'bob')
+        permissions = AnnotationPrincipalPermissionManager(self.ob1)
+        permissions.denyPermissionToPrincipal('P1', 'bob')
+        AnnotationPrincipalRoleManager(self.ob1).unsetRoleForPrincipal(
+            'R1', 'bob')
+        self.assertEqual(self._ids('principal', 'bob'), [self.uid1])
+        permissions.unsetPermissionForPrincipal('P1', 'bob')
+        self.assertEqual(self._ids('principal', 'bob'), [])
+        self.assertEqual(len(self.index._counts), 0)
+
+    def test_objects_without_intids(self):
+        ob = Manageable()
+        AnnotationPrincipalRoleManager(ob).assignRoleToPrincipal('R1', 'bob')
+        self.assertEqual(self._ids('principal', 'bob'), [])
+        # until they are indexed
+        self.index.indexObject(ob)
+        self.assertEqual(self._ids('principal', 'bob'), [])
+        uid = self.intids.register(ob)
+        self.index.indexObject(ob)
+        self.assertEqual(self._ids('principal', 'bob'), [uid])
+        self.assertEqual(self._ids('role', 'R1'), [uid])
+
+    def test_unindexObject(self):
+        AnnotationPrincipalRoleManager(self.ob1).assignRoleToPrincipal(
+            'R1', 'bob')
+        AnnotationPrincipalPermissionManager(
+            self.ob1).grantPermissionToPrincipal('P1', 'alice')
+        self.index.unindexObject(self.ob1)
+        self.assertEqual(self._ids('principal', 'bob'), [])
+        self.assertEqual(self._ids('principal', 'alice'), [])
+        self.assertEqual(self._ids('permission', 'P1'), [])
+        # and indexed again
+        self.index.indexObject(self.ob1)
+        self.assertEqual(self._ids('principal', 'alice'), [self.uid1])
+
+    def test_subscribers(self):
+        AnnotationPrincipalRoleManager(self.ob1).assignRoleToPrincipal(
+            'R1', 'bob')
+        unindexLocalGrants(self.ob1, None)
+        self.intids.unregister(self.ob1)
+        self.assertEqual(self._ids('principal', 'bob'), [])
+        uid = self.intids.register(self.ob1)
+        indexLocalGrants(self.ob1, None)
+        self.assertEqual(self._ids('principal', 'bob'), [uid])
+
+    def test_no_index(self):
+        zope.component.getSiteManager().unregisterUtility(
+            self.index, ILocalGrantIndex)
+        AnnotationPrincipalRoleManager(self.ob1).assignRoleToPrincipal(
+            'R1', 'bob')
+        self.assertEqual(self._ids('principal', 'bob'), [])
+        self.assertIsNone(AnnotationPrincipalRoleManager(self.ob1)._added)
+        indexLocalGrants(self.ob1, None)
+        unindexLocalGrants(self.ob1, None)
+
+
+class TestRevokeGrantsForPrincipals(PlacelessSetup, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        zope.component.provideAdapter(AttributeAnnotations)
+        self.intids = IntIdsStub()
+        zope.component.provideUtility(self.intids, IIntIds)
+        self.index = LocalGrantIndex()
+        zope.component.provideUtility(self.index, ILocalGrantIndex)
+        self.obs = [Manageable() for i in range(5)]
+        for ob in self.obs:
+            self.intids.register(ob)
+            AnnotationPrincipalRoleManager(ob).assignRolesToPrincipals(
+                ['R1', 'R2'], ['bob', 'alice'])
+        AnnotationPrincipalPermissionManager(
+            self.obs[2]).denyPermissionToPrincipal('P1', 'carol')
+        principalRoleManager.assignRoleToPrincipal('R1', 'bob', False)
+        principalPermissionManager.grantPermissionToPrincipal(
+            'P1', 'bob', False)
+        self.progress = []
+
+    def _progress(self, *args):
+        self.progress.append(args)
+
+    def test_revoke(self):
+        self.assertEqual(
+            revokeGrantsForPrincipals(['bob', 'carol'], batch_size=2,
+                                      progress=self._progress), 13)
+        self.assertEqual(self.progress, [(2, 5, 2), (4, 5, 4), (5, 5, 5)])
+        self.assertEqual(principalRoleManager.getRolesForPrincipal('bob'),
+                         [])
+        self.assertEqual(
+            principalPermissionManager.getPermissionsForPrincipal('bob'), [])
+        for ob in self.obs:
+            self.assertEqual(
+                sorted(AnnotationPrincipalRoleManager(
+                    ob).getPrincipalsAndRoles()),
+                [('R1', 'alice', Allow), ('R2', 'alice', Allow)])
+            self.assertEqual(
+                AnnotationPrincipalPermissionManager(
+                    ob).getPrincipalsAndPermissions(), [])
+        self.assertEqual(list(self.index.getObjectIds('principal', 'bob')),
+                         [])
+        self.assertEqual(len(self.index.getObjectIds('principal', 'alice')),
+                         5)
+        # nothing left to do
+        self.assertEqual(revokeGrantsForPrincipals(['bob', 'carol']), 0)
+
+    def test_resume(self):
+        self.assertEqual(
+            revokeGrantsForPrincipals(['alice'], start=3, commit=False,
+                                      progress=self._progress), 4)
+        self.assertEqual(self.progress, [(2, 2, 5)])
+        self.assertEqual(list(self.index.getObjectIds('principal', 'alice')),
+                         [1, 2, 3])
+        self.assertEqual(
+            revokeGrantsForPrincipals(['alice'], commit=False), 6)
+        self.assertEqual(list(self.index.getObjectIds('principal', 'alice')),
+                         [])
+        self.assertEqual(principalRoleManager.getRolesForPrincipal('bob'),
+                         [('R1', Allow)])
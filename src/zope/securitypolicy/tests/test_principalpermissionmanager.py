@@ -136,6 +136,17 @@ class Test(PlacelessSetup, unittest.TestCase):
         self.assertIn((perm1, Allow), perms)
         self.assertIn((perm2, Allow), perms)
 
+    def testIter(self):
+        perm1 = definePermission('Perm One', 'title').id
+        prin1 = self._make_principal()
+        manager.denyPermissionToPrincipal(perm1, prin1)
+        self.assertEqual(list(manager.iterPrincipalsForPermission(perm1)),
+                         [(prin1, Deny)])
+        self.assertEqual(list(manager.iterPermissionsForPrincipal(prin1)),
+                         [(perm1, Deny)])
+        self.assertEqual(list(manager.iterPrincipalsAndPermissions()),
+                         [(perm1, prin1, Deny)])
+
     def testManyPrincipalsOnePermission(self):
         perm1 = definePermission('Perm One', 'title').id
         prin1 = self._make_principal()
@@ -146,3 +157,23 @@ class Test(PlacelessSetup, unittest.TestCase):
         self.assertEqual(len(principals), 2)
         self.assertIn((prin1, Allow), principals)
         self.assertIn((prin2, Deny), principals)
+
+    def testBulk(self):
+        perm1 = definePermission('Perm One', 'title').id
+        perm2 = definePermission('Perm Two', 'title').id
+        prin1 = self._make_principal()
+        self.assertEqual(
+            manager.grantPermissionsToPrincipal(iter([perm1, perm2]), prin1),
+            2)
+        self.assertEqual(manager.getPermissionsForPrincipal(prin1),
+                         [(perm1, Allow), (perm2, Allow)])
+        self.assertEqual(
+            manager.denyPermissionsToPrincipal([perm1, perm2], prin1), 2)
+        self.assertEqual(manager.getSetting(perm1, prin1), Deny)
+        self.assertEqual(
+            manager.unsetPermissionsForPrincipal([perm1], prin1), 1)
+        self.assertEqual(manager.getPermissionsForPrincipal(prin1),
+                         [(perm2, Deny)])
+        self.assertRaises(ValueError,
+                          manager.grantPermissionsToPrincipal,
+                          [perm1], 'prin2')
@@ -53,6 +53,23 @@ class Test(PlacelessSetup, unittest.TestCase):
         self.assertEqual(principalRoleManager.getRolesForPrincipal(principal),
                          [])
 
+    def testRoleMasksForPrincipal(self):
+        from zope.securitypolicy.rolemask import roleBit
+        role1 = defineRole('ARole', 'A Role').id
+        role2 = defineRole('BRole', 'B Role').id
+        principal = self._make_principal()
+        self.assertEqual(
+            principalRoleManager.getRoleMasksForPrincipal(principal), (0, 0))
+        principalRoleManager.assignRoleToPrincipal(role1, principal)
+        principalRoleManager.removeRoleFromPrincipal(role2, principal)
+        self.assertEqual(
+            principalRoleManager.getRoleMasksForPrincipal(principal),
+            (roleBit(role1), roleBit(role2)))
+        principalRoleManager.unsetRoleForPrincipal(role1, principal)
+        self.assertEqual(
+            principalRoleManager.getRoleMasksForPrincipal(principal),
+            (0, roleBit(role2)))
+
     def testPrincipalRoleAllow(self):
         role = defineRole('ARole', 'A Role').id
         principal = self._make_principal()
@@ -135,3 +152,44 @@ class Test(PlacelessSetup, unittest.TestCase):
         self.assertIn((role1, prin1, Allow), principalsAndRoles)
         self.assertIn((role1, prin2, Allow), principalsAndRoles)
         self.assertIn((role2, prin1, Allow), principalsAndRoles)
+
+    def testIter(self):
+        role1 = defineRole('Role One', 'Role #1').id
+        prin1 = self._make_principal()
+        principalRoleManager.removeRoleFromPrincipal(role1, prin1)
+        self.assertEqual(
+            list(principalRoleManager.iterPrincipalsForRole(role1)),
+            [(prin1, Deny)])
+        self.assertEqual(
+            list(principalRoleManager.iterRolesForPrincipal(prin1)),
+            [(role1, Deny)])
+        self.assertEqual(list(principalRoleManager.iterPrincipalsAndRoles()),
+                         [(role1, prin1, Deny)])
+
+    def testBulk(self):
+        role1 = defineRole('Role One', 'Role #1').id
+        role2 = defineRole('Role Two', 'Role #2').id
+        prin1 = self._make_principal()
+        prin2 = self._make_principal('Principal 2', 'Principal Two')
+        principalRoleManager.assignRoleToPrincipal(role1, prin1)
+        self.assertEqual(
+            principalRoleManager.assignRolesToPrincipals(
+                [role1, role2], iter([prin1, prin2])), 3)
+        self.assertEqual(len(principalRoleManager.getPrincipalsAndRoles()), 4)
+        self.assertEqual(
+            principalRoleManager.removeRolesFromPrincipals([role2], [prin2]),
+            1)
+        self.assertEqual(principalRoleManager.getSetting(role2, prin2), Deny)
+        self.assertEqual(
+            principalRoleManager.unsetRolesForPrincipals(
+                [role1, role2], [prin2]), 2)
+        self.assertEqual(principalRoleManager.getRolesForPrincipal(prin2), [])
+        self.assertRaises(ValueError,
+                          principalRoleManager.assignRolesToPrincipals,
+                          [role1, 'role3'], [prin1])
+        self.assertRaises(ValueError,
+                          principalRoleManager.assignRolesToPrincipals,
+                          [role1], [prin1, 'prin3'])
+        self.assertEqual(
+            principalRoleManager.assignRolesToPrincipals(
+                ['role3'], ['prin3'], check=False), 1)
@@ -13,8 +13,53 @@
 ##############################################################################
 """Doctests for 'role' module.
 """
+import unittest
 from doctest import DocTestSuite
 
+from zope.component import getGlobalSiteManager
+from zope.component import provideUtility
+from zope.component.testing import PlacelessSetup
+
+from zope.securitypolicy.interfaces import IRole
+from zope.securitypolicy.role import Role
+from zope.securitypolicy.role import checkRole
+from zope.securitypolicy.role import getRoleIds
+
+
+class TestCheckRole(PlacelessSetup, unittest.TestCase):
+
+    def test_checkRole(self):
+        self.assertRaises(ValueError, checkRole, None, 'role1')
+        role1 = Role('role1', 'Role 1')
+        provideUtility(role1, IRole, role1.id)
+        checkRole(None, 'role1')
+        self.assertRaises(ValueError, checkRole, None, 'role2')
+
+    def test_cached_until_roles_change(self):
+        role1 = Role('role1', 'Role 1')
+        provideUtility(role1, IRole, role1.id)
+        self.assertEqual(getRoleIds(None), ('role1',))
+        self.assertIs(getRoleIds(None), getRoleIds(None))
+        # Nothing subscribes to registration events here
+        getGlobalSiteManager().unregisterUtility(role1, IRole, role1.id)
+        self.assertRaises(ValueError, checkRole, None, 'role1')
+        provideUtility(role1, IRole, 'role1')
+        checkRole(None, 'role1')
+
+    def test_local_site_manager(self):
+        from zope.interface.registry import Components
+        sm = Components(bases=(getGlobalSiteManager(),))
+        sm.registerUtility(Role('role2', 'Role 2'), IRole, 'role2')
+        self.assertEqual(getRoleIds(sm), ('role2',))
+        # Changes to the base registries are seen too
+        provideUtility(Role('role1', 'Role 1'), IRole, 'role1')
+        checkRole(sm, 'role1')
+        self.assertEqual(sorted(getRoleIds(sm)), ['role1', 'role2'])
+        self.assertRaises(ValueError, checkRole, None, 'role2')
+
 
 def test_suite():
-    return DocTestSuite('zope.securitypolicy.role')
+    return unittest.TestSuite([
+        unittest.defaultTestLoader.loadTestsFromName(__name__),
+        DocTestSuite('zope.securitypolicy.role'),
+    ])
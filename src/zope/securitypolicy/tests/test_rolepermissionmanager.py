@@ -50,6 +50,23 @@ class Test(PlacelessSetup, unittest.TestCase):
         self.assertEqual(manager.getSetting(permission, role), Unset)
         self.assertEqual(manager.getSetting(permission, role, 1), 1)
 
+    def testRoleMaskForPermission(self):
+        from zope.securitypolicy.rolemask import roleMask
+        permission = definePermission('APerm', 'aPerm title').id
+        role1 = defineRole('ARole', 'A Role').id
+        role2 = defineRole('BRole', 'B Role').id
+        self.assertEqual(manager.getRoleMaskForPermission(permission), 0)
+        manager.grantPermissionToRole(permission, role1)
+        manager.denyPermissionToRole(permission, role2)
+        self.assertEqual(manager.getRoleMaskForPermission(permission),
+                         roleMask([role1]))
+        manager.grantPermissionToRole(permission, role2)
+        self.assertEqual(manager.getRoleMaskForPermission(permission),
+                         roleMask([role1, role2]))
+        manager.unsetPermissionFromRole(permission, role1)
+        self.assertEqual(manager.getRoleMaskForPermission(permission),
+                         roleMask([role2]))
+
     def testRolePermission(self):
         permission = definePermission('APerm', 'aPerm title').id
         role = defineRole('ARole', 'A Role').id
@@ -96,6 +113,17 @@ class Test(PlacelessSetup, unittest.TestCase):
         self.assertIn((perm2, Allow), perms)
         self.assertIn((perm3, Allow), perms)
 
+    def testIter(self):
+        perm1 = definePermission('Perm One', 'P1').id
+        role1 = defineRole('Role One', 'Role #1').id
+        manager.grantPermissionToRole(perm1, role1)
+        self.assertEqual(list(manager.iterRolesForPermission(perm1)),
+                         [(role1, Allow)])
+        self.assertEqual(list(manager.iterPermissionsForRole(role1)),
+                         [(perm1, Allow)])
+        self.assertEqual(list(manager.iterRolesAndPermissions()),
+                         [(perm1, role1, Allow)])
+
     def testManyRolesOnePermission(self):
         perm1 = definePermission('Perm One', 'title').id
         role1 = defineRole('Role One', 'Role #1').id
@@ -124,3 +152,22 @@ class Test(PlacelessSetup, unittest.TestCase):
         self.assertRaises(ValueError,
                           manager.grantPermissionToRole, perm1, 'role1'
                           )
+
+    def testBulk(self):
+        perm1 = definePermission('Perm One', 'P1').id
+        perm2 = definePermission('Perm Two', 'P2').id
+        role1 = defineRole('Role One', 'Role #1').id
+        manager.grantPermissionToRole(perm1, role1)
+        self.assertEqual(
+            manager.grantPermissionsToRole(iter([perm1, perm2]), role1), 1)
+        self.assertEqual(manager.getPermissionsForRole(role1),
+                         [(perm1, Allow), (perm2, Allow)])
+        self.assertEqual(manager.denyPermissionsToRole([perm2], role1), 1)
+        self.assertEqual(manager.getSetting(perm2, role1), Deny)
+        self.assertEqual(
+            manager.unsetPermissionsFromRole([perm1, perm2, 'P3'], role1), 2)
+        self.assertEqual(manager.getPermissionsForRole(role1), [])
+        self.assertRaises(ValueError,
+                          manager.grantPermissionsToRole, [perm1], 'role2')
+        self.assertEqual(
+            manager.grantPermissionsToRole([perm1], 'role2', check=False), 1)
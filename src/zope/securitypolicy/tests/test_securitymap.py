@@ -22,6 +22,8 @@ from zope.security.management import setSecurityPolicy
 
 from zope.securitypolicy.securitymap import PersistentSecurityMap
 from zope.securitypolicy.securitymap import SecurityMap
+from zope.securitypolicy.securitymap import getGeneration
+from zope.securitypolicy.securitymap import internId
 
 
 class InteractionStub:
@@ -31,6 +33,15 @@ class InteractionStub:
         self.invalidated += 1
 
 
+class ScopedInteractionStub(InteractionStub):
+
+    def __init__(self):
+        self.invalidated_for = []
+
+    def invalidate_cache_for(self, ob):
+        self.invalidated_for.append(ob)
+
+
 class TestSecurityMap(unittest.TestCase):
 
     def setUp(self):
@@ -62,6 +73,17 @@ class TestSecurityMap(unittest.TestCase):
         self.assertEqual(map._byrow[5][3], 'fd')
         self.assertEqual(map._bycol[3][5], 'fd')
 
+    def test_addCell_bumps_generation(self):
+        map = self._getSecurityMap()
+        generation = getGeneration()
+        map.addCell(0, 0, 'aa')
+        self.assertNotEqual(generation, getGeneration())
+        generation = getGeneration()
+        map.addCell(0, 0, 'aa')
+        self.assertEqual(generation, getGeneration())
+        map.delCell(0, 0)
+        self.assertNotEqual(generation, getGeneration())
+
     def test_addCell_no_invalidation(self):
 
         class NoInvalidation:
@@ -79,6 +101,17 @@ class TestSecurityMap(unittest.TestCase):
         map.addCell(0, 0, 'aa')
         self.assertIn('invalidate_cache', getInteraction().attrs)
 
+    def test_addCell_scoped_invalidation(self):
+        setSecurityPolicy(ScopedInteractionStub)
+        endInteraction()
+        newInteraction()
+
+        map = self._getSecurityMap()
+        map.addCell(0, 0, 'aa')
+        map.delCell(0, 0)
+        self.assertEqual(getInteraction().invalidated_for, [None, None])
+        self.assertEqual(getInteraction().invalidated, 0)
+
     def test_addCell_noninteger(self):
         map = self._getSecurityMap()
         map.addCell(0.3, 0.4, 'entry')
@@ -90,6 +123,14 @@ class TestSecurityMap(unittest.TestCase):
         self.assertEqual(map._byrow['a']['b'], marker)
         self.assertEqual(map._bycol['b']['a'], marker)
 
+    def test_addCell_interns_ids(self):
+        map = self._getSecurityMap()
+        row, col = ''.join(['ro', 'w']), ''.join(['co', 'l'])
+        map.addCell(row, col, 'aa')
+        self.assertIs(list(map._byrow)[0], internId('row'))
+        self.assertIs(list(map._bycol)[0], internId('col'))
+        self.assertIs(list(map._byrow[row])[0], internId('col'))
+
     def test_delCell(self):
         map = self._getSecurityMap()
         self.assertEqual(getInteraction().invalidated, 0)
@@ -102,6 +143,27 @@ class TestSecurityMap(unittest.TestCase):
         self.assertEqual(map._byrow.get(0), None)
         self.assertEqual(map._bycol.get(1), None)
 
+    def test_addCells(self):
+        map = self._getSecurityMap()
+        cells = [(0, 0, 'aa'), (1, 0, 'ba'), (0, 0, 'aa')]
+        self.assertEqual(map.addCells(cells), 2)
+        self.assertEqual(getInteraction().invalidated, 1)
+        self.assertEqual(map.getCol(0), [(0, 'aa'), (1, 'ba')])
+
+        # Nothing changed, nothing invalidated
+        self.assertEqual(map.addCells([(0, 0, 'aa')]), 0)
+        self.assertEqual(getInteraction().invalidated, 1)
+
+    def test_delCells(self):
+        map = self._getSecurityMap()
+        map.addCells([(0, 0, 'aa'), (1, 0, 'ba'), (1, 1, 'bb')])
+        self.assertEqual(map.delCells([(0, 0), (1, 0), (2, 2)]), 2)
+        self.assertEqual(getInteraction().invalidated, 2)
+        self.assertEqual(map.getAllCells(), [(1, 1, 'bb')])
+
+        self.assertEqual(map.delCells([(0, 0)]), 0)
+        self.assertEqual(getInteraction().invalidated, 2)
+
     def test_queryCell(self):
         map = self._getSecurityMap()
         map._byrow[0] = {}
@@ -175,6 +237,29 @@ class TestSecurityMap(unittest.TestCase):
         self.assertEqual(map.getCol(2), [(0, 'ac')])
         self.assertEqual(map.getCol(0), [])
 
+    def test_iterRow_iterCol(self):
+        map = self._getSecurityMap()
+        map.addCells([(0, 1, 'ab'), (0, 2, 'ac'), (1, 1, 'bb')])
+        rows = map.iterRow(0)
+        self.assertIs(iter(rows), rows)
+        self.assertEqual(sorted(rows), [(1, 'ab'), (2, 'ac')])
+        self.assertEqual(list(map.iterRow(2)), [])
+        cols = map.iterCol(1)
+        self.assertIs(iter(cols), cols)
+        self.assertEqual(sorted(cols), [(0, 'ab'), (1, 'bb')])
+        self.assertEqual(list(map.iterCol(0)), [])
+
+    def test_iterAllCells(self):
+        map = self._getSecurityMap()
+        self.assertEqual(list(map.iterAllCells()), [])
+        map.addCells([(0, 1, 'ab'), (0, 2, 'ac'), (1, 1, 'bb')])
+        cells = map.iterAllCells()
+        self.assertIs(iter(cells), cells)
+        self.assertEqual(sorted(cells),
+                         [(0, 1, 'ab'), (0, 2, 'ac'), (1, 1, 'bb')])
+        self.assertEqual(sorted(map.getAllCells()),
+                         [(0, 1, 'ab'), (0, 2, 'ac'), (1, 1, 'bb')])
+
 
 class TestPersistentSecurityMap(TestSecurityMap):
 
@@ -182,6 +267,256 @@ class TestPersistentSecurityMap(TestSecurityMap):
         return PersistentSecurityMap()
 
 
+class TestBTreePersistentSecurityMap(TestSecurityMap):
+
+    def _getSecurityMap(self):
+        map = PersistentSecurityMap()
+        map.btree_threshold = 0
+        return map
+
+    def test_addCell_noninteger(self):
+        # BTree keys need to be comparable with each other
+        map = self._getSecurityMap()
+        map.addCell(0.3, 0.4, 'entry')
+        self.assertEqual(map._byrow[0.3][0.4], 'entry')
+        self.assertEqual(map._bycol[0.4][0.3], 'entry')
+
+    def test_stored_in_btrees(self):
+        from BTrees.OOBTree import OOBTree
+        map = self._getSecurityMap()
+        map.addCell('row', 'col', 'val')
+        self.assertIsInstance(map._byrow, OOBTree)
+        self.assertIsInstance(map._byrow['row'], OOBTree)
+        self.assertIsInstance(map._bycol['col'], OOBTree)
+
+
+class JarStub:
+
+    def __init__(self):
+        self.registered = []
+
+    def register(self, ob):
+        self.registered.append(ob)
+
+
+class TestPersistentSecurityMapMigration(unittest.TestCase):
+
+    def _makeOne(self):
+        map = PersistentSecurityMap()
+        map.addCell('r1', 'c1', 'v1')
+        map.addCell('r1', 'c2', 'v2')
+        map._p_jar = JarStub()
+        map._p_oid = b'1'
+        map._p_changed = False
+        return map
+
+    def test_dicts_below_threshold(self):
+        map = self._makeOne()
+        map.btree_threshold = 4
+        map.addCell('r2', 'c1', 'v3')
+        self.assertIsInstance(map._byrow, dict)
+        self.assertEqual(map._p_jar.registered, [map])
+
+    def test_migrated_once_over_threshold(self):
+        from BTrees.OOBTree import OOBTree
+        map = self._makeOne()
+        map.btree_threshold = 3
+        map.addCell('r2', 'c1', 'v3')
+        self.assertIsInstance(map._byrow, OOBTree)
+        self.assertIsInstance(map._bycol['c1'], OOBTree)
+        self.assertEqual(
+            sorted(map.getAllCells()),
+            [('r1', 'c1', 'v1'), ('r1', 'c2', 'v2'), ('r2', 'c1', 'v3')])
+        self.assertEqual(map.getCol('c1'), [('r1', 'v1'), ('r2', 'v3')])
+
+        # Once in BTrees, changes don't rewrite the map itself
+        map._p_changed = False
+        del map._p_jar.registered[:]
+        map.delCell('r1', 'c1')
+        map.addCell('r3', 'c3', 'v4')
+        self.assertEqual(map._p_jar.registered, [])
+        self.assertEqual(map.queryCell('r3', 'c3'), 'v4')
+        self.assertIsNone(map.queryCell('r1', 'c1'))
+
+    def test_no_threshold(self):
+        map = self._makeOne()
+        for i in range(100):
+            map.addCell('r', 'c%d' % i, 'v')
+        self.assertIsInstance(map._byrow, dict)
+
+
+class TestPersistentSecurityMapPickling(unittest.TestCase):
+
+    def test_unpickling_interns_ids(self):
+        import pickle
+
+        map = PersistentSecurityMap()
+        map.addCell('row', 'col', 'value')
+        map.addCell(0, 1, 'value')
+        state = pickle.loads(pickle.dumps(map.__getstate__()))
+
+        copy = PersistentSecurityMap.__new__(PersistentSecurityMap)
+        copy.__setstate__(state)
+        self.assertIs(list(copy._byrow)[0], internId('row'))
+        self.assertIs(list(copy._bycol)[0], internId('col'))
+        self.assertIs(list(copy._bycol['col'])[0], internId('row'))
+        self.assertEqual(copy._byrow[0], {1: 'value'})
+
+
+class RowsOnlySecurityMap(PersistentSecurityMap):
+    rows_only = True
+
+
+def loadSecurityMap(state, factory=RowsOnlySecurityMap):
+    import pickle
+    map = factory.__new__(factory)
+    map.__setstate__(pickle.loads(pickle.dumps(state)))
+    return map
+
+
+class TestRowsOnly(unittest.TestCase):
+
+    def _makeOne(self):
+        map = RowsOnlySecurityMap()
+        map.addCell('r1', 'c1', 'v1')
+        map.addCell('r2', 'c1', 'v2')
+        return map
+
+    def test_columns_not_stored(self):
+        state = self._makeOne().__getstate__()
+        self.assertEqual(sorted(state), ['_byrow'])
+
+    def test_columns_derived(self):
+        map = loadSecurityMap(self._makeOne().__getstate__())
+        self.assertNotIn('_v_bycol', map.__dict__)
+        self.assertEqual(map.getRow('r1'), [('c1', 'v1')])
+        self.assertNotIn('_v_bycol', map.__dict__)
+        self.assertEqual(map.getCol('c1'), [('r1', 'v1'), ('r2', 'v2')])
+        self.assertIs(map._bycol, map._v_bycol)
+        self.assertRaises(AttributeError, getattr, map, 'other')
+
+        # The derived columns are kept up to date
+        map.addCell('r3', 'c1', 'v3')
+        map.delCell('r1', 'c1')
+        self.assertEqual(map.getCol('c1'), [('r2', 'v2'), ('r3', 'v3')])
+        self.assertEqual(sorted(map.__getstate__()), ['_byrow'])
+
+    def test_columns_dropped_from_old_state(self):
+        full = PersistentSecurityMap()
+        full.addCell('r1', 'c1', 'v1')
+        map = loadSecurityMap(full.__getstate__())
+        self.assertEqual(map.getCol('c1'), [('r1', 'v1')])
+        self.assertEqual(sorted(map.__getstate__()), ['_byrow'])
+
+    def test_columns_stored_again(self):
+        map = loadSecurityMap(self._makeOne().__getstate__(),
+                              PersistentSecurityMap)
+        state = map.__getstate__()
+        self.assertEqual(state['_bycol'],
+                         {'c1': {'r1': 'v1', 'r2': 'v2'}})
+
+
+class TestBatchedChanges(unittest.TestCase):
+
+    def setUp(self):
+        self.oldpolicy = setSecurityPolicy(ScopedInteractionStub)
+        newInteraction()
+
+    def tearDown(self):
+        endInteraction()
+        setSecurityPolicy(self.oldpolicy)
+
+    def _makeMap(self, context=None):
+        map = PersistentSecurityMap()
+        map._context = context
+        map._p_jar = JarStub()
+        map._p_oid = b'1'
+        return map
+
+    def test_invalidated_once(self):
+        from zope.securitypolicy.securitymap import batchedChanges
+        map = self._makeMap('context')
+        generation = getGeneration()
+        with batchedChanges():
+            map.addCell('r1', 'c1', 'v')
+            map.addCells([('r2', 'c1', 'v'), ('r3', 'c1', 'v')])
+            map.delCell('r1', 'c1')
+            self.assertEqual(getInteraction().invalidated_for, [])
+            # the generation changes right away, so that other caches
+            # don't keep decisions made before
+            self.assertNotEqual(getGeneration(), generation)
+            # maps are marked as changed right away
+            self.assertEqual(map._p_jar.registered, [map])
+        self.assertEqual(getInteraction().invalidated_for, ['context'])
+        self.assertNotEqual(getGeneration(), generation)
+        self.assertEqual(map.getCol('c1'), [('r2', 'v'), ('r3', 'v')])
+
+    def test_several_objects(self):
+        from zope.securitypolicy.securitymap import batchedChanges
+        map1 = self._makeMap('context1')
+        map2 = self._makeMap('context2')
+        with batchedChanges():
+            map1.addCell('r', 'c', 'v')
+            map2.addCell('r', 'c', 'v')
+        self.assertEqual(getInteraction().invalidated_for, [None])
+        self.assertEqual(map1._p_jar.registered, [map1])
+        self.assertEqual(map2._p_jar.registered, [map2])
+
+    def test_nothing_changed(self):
+        from zope.securitypolicy.securitymap import batchedChanges
+        map = self._makeMap('context')
+        with batchedChanges():
+            map.delCell('r', 'c')
+        self.assertEqual(getInteraction().invalidated_for, [])
+
+    def test_nested(self):
+        from zope.securitypolicy.securitymap import batchedChanges
+        map = self._makeMap('context')
+        with batchedChanges():
+            with batchedChanges():
+                map.addCell('r', 'c', 'v')
+            self.assertEqual(getInteraction().invalidated_for, [])
+        self.assertEqual(getInteraction().invalidated_for, ['context'])
+
+    def test_error(self):
+        from zope.securitypolicy.securitymap import batchedChanges
+        map = self._makeMap('context')
+        with self.assertRaises(ValueError):
+            with batchedChanges():
+                map.addCell('r', 'c', 'v')
+                raise ValueError
+        self.assertEqual(getInteraction().invalidated_for, ['context'])
+        self.assertEqual(map._p_jar.registered, [map])
+        map.addCell('r2', 'c', 'v')
+        self.assertEqual(getInteraction().invalidated_for,
+                         ['context', 'context'])
+
+    def test_commit_within_block(self):
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.DemoStorage import DemoStorage
+
+        from zope.securitypolicy.securitymap import batchedChanges
+        db = DB(DemoStorage())
+        self.addCleanup(db.close)
+        conn = db.open()
+        conn.root()['map'] = PersistentSecurityMap()
+        transaction.commit()
+        generation = getGeneration()
+        with batchedChanges():
+            conn.root()['map'].addCell('r', 'c', 'v')
+            transaction.commit()
+            self.assertNotEqual(getGeneration(), generation)
+            self.assertEqual(getInteraction().invalidated_for, [None])
+            conn.root()['map'].addCell('r2', 'c', 'v')
+            transaction.abort()
+        conn.close()
+
+        conn = db.open()
+        self.assertEqual(conn.root()['map'].getAllCells(), [('r', 'c', 'v')])
+        conn.close()
+
+
 class TestAnnotationSecurityMap(unittest.TestCase):
 
     def test_changed_sets_map(self):
@@ -214,3 +549,155 @@ class TestAnnotationSecurityMap(unittest.TestCase):
         self.assertIn(ASM.key, context.annotations)
         psm = context.annotations[ASM.key]
         self.assertIs(psm, sec_map.map)
+
+    def _makeContext(self):
+        from zope.annotation.interfaces import IAnnotations
+
+        class Context:
+            def __init__(self):
+                self.annotations = {}
+
+            def __conform__(self, iface):
+                if iface is IAnnotations:
+                    return self.annotations
+
+        return Context()
+
+    def test_local_grants_marker(self):
+        from zope.securitypolicy.interfaces import IHasLocalGrants
+        from zope.securitypolicy.securitymap import AnnotationSecurityMap
+
+        class ASM1(AnnotationSecurityMap):
+            key = 'key1'
+
+        class ASM2(AnnotationSecurityMap):
+            key = 'key2'
+
+        context = self._makeContext()
+        self.assertFalse(IHasLocalGrants.providedBy(context))
+        ASM1(context).addCell('row', 'col', 'val')
+        self.assertTrue(IHasLocalGrants.providedBy(context))
+        ASM2(context).addCell('row', 'col', 'val')
+        ASM1(context).delCell('row', 'col')
+        self.assertTrue(IHasLocalGrants.providedBy(context))
+        ASM2(context).delCell('row', 'col')
+        self.assertFalse(IHasLocalGrants.providedBy(context))
+
+    def test_local_grants_marker_slots(self):
+        # Objects that can't be marked still get their grants
+        from zope.annotation.interfaces import IAnnotations
+
+        from zope.securitypolicy.interfaces import IHasLocalGrants
+        from zope.securitypolicy.securitymap import AnnotationSecurityMap
+        from zope.securitypolicy.securitymap import updateLocalGrantsMarker
+
+        class ASM(AnnotationSecurityMap):
+            key = 'key4'
+
+        class Context:
+            __slots__ = ('annotations',)
+
+            def __init__(self):
+                self.annotations = {}
+
+            def __conform__(self, iface):
+                if iface is IAnnotations:
+                    return self.annotations
+
+        context = Context()
+        ASM(context).addCell('row', 'col', 'val')
+        ASM(context).addCells([('row2', 'col', 'val')])
+        self.assertFalse(IHasLocalGrants.providedBy(context))
+        self.assertEqual(ASM(context).getCell('row', 'col'), 'val')
+        self.assertEqual(ASM(context).getCell('row2', 'col'), 'val')
+        self.assertTrue(updateLocalGrantsMarker(context))
+        ASM(context).delCells([('row', 'col'), ('row2', 'col')])
+        self.assertEqual(ASM(context).getAllCells(), [])
+
+    def test_updateLocalGrantsMarker(self):
+        from zope.securitypolicy.interfaces import IHasLocalGrants
+        from zope.securitypolicy.securitymap import AnnotationSecurityMap
+        from zope.securitypolicy.securitymap import updateLocalGrantsMarker
+
+        class ASM(AnnotationSecurityMap):
+            key = 'key3'
+
+        # Grants made before the marker was maintained
+        context = self._makeContext()
+        psm = PersistentSecurityMap()
+        psm.addCell('row', 'col', 'val')
+        context.annotations['key3'] = psm
+        self.assertFalse(IHasLocalGrants.providedBy(context))
+
+        self.assertTrue(updateLocalGrantsMarker(context))
+        self.assertTrue(IHasLocalGrants.providedBy(context))
+        psm.delCell('row', 'col')
+        self.assertFalse(updateLocalGrantsMarker(context))
+        self.assertFalse(IHasLocalGrants.providedBy(context))
+        self.assertFalse(updateLocalGrantsMarker(object()))
+
+    def test_migrated_to_btrees(self):
+        from BTrees.OOBTree import OOBTree
+
+        from zope.securitypolicy.securitymap import AnnotationSecurityMap
+
+        class ASM(AnnotationSecurityMap):
+            key = 'key'
+
+        context = self._makeContext()
+        ASM(context).addCell('row', 'col', 'val')
+        psm = context.annotations['key']
+        psm.btree_threshold = 1
+
+        sec_map = ASM(context)
+        sec_map.addCell('row2', 'col', 'val2')
+        self.assertIs(context.annotations['key'], psm)
+        self.assertIsInstance(psm._byrow, OOBTree)
+        self.assertIs(sec_map._byrow, psm._byrow)
+        self.assertIs(sec_map._bycol, psm._bycol)
+        self.assertEqual(ASM(context).getCol('col'),
+                         [('row', 'val'), ('row2', 'val2')])
+
+    def test_columns_looked_up_lazily(self):
+        from zope.securitypolicy.securitymap import AnnotationSecurityMap
+
+        class ASM(AnnotationSecurityMap):
+            key = 'key'
+
+        context = self._makeContext()
+        map = RowsOnlySecurityMap()
+        map.addCell('row', 'col', 'val')
+        map = loadSecurityMap(map.__getstate__())
+        context.annotations['key'] = map
+
+        sec_map = ASM(context)
+        self.assertEqual(sec_map.getRow('row'), [('col', 'val')])
+        self.assertNotIn('_v_bycol', map.__dict__)
+        self.assertEqual(sec_map.getCol('col'), [('row', 'val')])
+        sec_map.addCell('row2', 'col', 'val2')
+        self.assertEqual(map.getCol('col'), [('row', 'val'), ('row2', 'val2')])
+
+    def test_invalidates_context_only(self):
+        from zope.annotation.interfaces import IAnnotations
+
+        from zope.securitypolicy.securitymap import AnnotationSecurityMap
+
+        class Context:
+            annotations = {}
+
+            def __conform__(self, iface):
+                if iface is IAnnotations:
+                    return self.annotations
+
+        class ASM(AnnotationSecurityMap):
+            key = 'key'
+
+        oldpolicy = setSecurityPolicy(ScopedInteractionStub)
+        newInteraction()
+        try:
+            context = Context()
+            ASM(context).addCell('row', 'col', 'val')
+            self.assertEqual(getInteraction().invalidated_for, [context])
+        finally:
+            endInteraction()
+            setSecurityPolicy(oldpolicy)
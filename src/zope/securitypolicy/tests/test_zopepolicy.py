@@ -14,7 +14,9 @@
 """Tests the zope policy.
 """
 
+import sys
 import unittest
+import weakref
 from doctest import DocFileSuite
 
 from zope.annotation.attribute import AttributeAnnotations
@@ -24,19 +26,27 @@ from zope.component import provideAdapter
 from zope.component.testing import setUp as componentSetUp
 from zope.component.testing import tearDown as componentTearDown
 from zope.security.management import endInteraction
+from zope.security.management import newInteraction
+from zope.security.management import queryInteraction
 from zope.testing.cleanup import CleanUp
 
 from zope import interface
+from zope.securitypolicy import securitymap
 from zope.securitypolicy import zopepolicy
 from zope.securitypolicy.grantinfo import AnnotationGrantInfo
+from zope.securitypolicy.interfaces import Allow
+from zope.securitypolicy.interfaces import Deny
 from zope.securitypolicy.interfaces import IGrantInfo
 from zope.securitypolicy.interfaces import IPrincipalPermissionManager
 from zope.securitypolicy.interfaces import IPrincipalRoleManager
 from zope.securitypolicy.interfaces import IRolePermissionManager
 from zope.securitypolicy.principalpermission import \
     AnnotationPrincipalPermissionManager
+from zope.securitypolicy.principalpermission import principalPermissionManager
 from zope.securitypolicy.principalrole import AnnotationPrincipalRoleManager
+from zope.securitypolicy.principalrole import principalRoleManager
 from zope.securitypolicy.rolepermission import AnnotationRolePermissionManager
+from zope.securitypolicy.rolepermission import rolePermissionManager
 
 
 class TestZCML(CleanUp, unittest.TestCase):
@@ -138,6 +148,191 @@ class TestZopePolicy(CleanUp, unittest.TestCase):
         self.assertTrue(self.policy.checkPermission('perm', self))
         self.assertEqual(1, len(invoked_counter))
 
+    def test_cache_entries_are_reused(self):
+        ob = object()
+        self.assertIs(self.policy.cache(ob), self.policy.cache(ob))
+
+    def test_cache_size(self):
+        self.policy.cache_size = 2
+        ob1, ob2, ob3 = object(), object(), object()
+        entry1 = self.policy.cache(ob1)
+        self.policy.cache(ob2)
+        # Using ob1 makes ob2 the least recently used object
+        self.policy.cache(ob1)
+        self.policy.cache(ob3)
+        self.assertEqual(len(self.policy._cache), 2)
+        self.assertIs(self.policy.cache(ob1), entry1)
+        self.assertNotIn(id(ob2), self.policy._cache)
+
+    def test_cache_size_keeps_memory_flat(self):
+        self.policy.cache_size = 10
+        self.policy.add(Participation(Principal('bob')))
+        root = object()
+        obs = [PersistentOb(None, root) for i in range(100)]
+        for ob in obs:
+            self.assertFalse(self.policy.checkPermission('P1', ob))
+        self.assertEqual(len(self.policy._cache), 10)
+
+    def test_cache_size_none(self):
+        self.policy.cache_size = None
+        obs = [object() for i in range(20)]
+        for ob in obs:
+            self.policy.cache(ob)
+        self.assertEqual(len(self.policy._cache), 20)
+
+    def test_cache_does_not_keep_objects_alive(self):
+        import gc
+
+        class Ob:
+            pass
+
+        ob = Ob()
+        ref = weakref.ref(ob)
+        self.policy.cache(ob)
+        self.assertIn(id(ob), self.policy._cache)
+
+        key = id(ob)
+        del ob
+        gc.collect()
+        self.assertIsNone(ref())
+        self.assertNotIn(key, self.policy._cache)
+
+    def test_cache_keeps_objects_without_weakref_support(self):
+        ob = object()
+        entry = self.policy.cache(ob)
+        self.assertIs(self.policy._cache[id(ob)][1](), ob)
+        self.assertIs(self.policy.cache(ob), entry)
+
+    def test_cache_forget_replaced_entry(self):
+        # A stale callback doesn't remove a newer entry under the same key
+
+        class Ob:
+            pass
+
+        ob = Ob()
+        self.policy.cache(ob)
+        forget = zopepolicy._forget(self.policy._cache, id(ob))
+        forget(weakref.ref(ob))
+        self.assertIn(id(ob), self.policy._cache)
+
+    def _makeTree(self):
+        class Ob:
+            def __init__(self, parent=None):
+                self.__parent__ = parent
+
+        root = Ob()
+        folder = Ob(root)
+        doc = Ob(folder)
+        other = Ob(root)
+        for ob in (None, root, folder, doc, other):
+            self.policy.cache(ob)
+        self.policy._groups['bob'] = ()
+        return root, folder, doc, other
+
+    def test_invalidate_cache_for_subtree(self):
+        root, folder, doc, other = self._makeTree()
+        self.policy.invalidate_cache_for(folder)
+        self.assertEqual(
+            set(self.policy._cache),
+            {id(None), id(root), id(other)})
+        self.assertEqual(self.policy._groups, {'bob': ()})
+
+    def test_invalidate_cache_for_proxied(self):
+        from zope.security.checker import ProxyFactory
+        root, folder, doc, other = self._makeTree()
+        self.policy.invalidate_cache_for(ProxyFactory(doc))
+        self.assertEqual(
+            set(self.policy._cache),
+            {id(None), id(root), id(folder), id(other)})
+
+    def test_invalidate_cache_for_uncached_ancestor(self):
+        class Ob:
+            def __init__(self, parent=None):
+                self.__parent__ = parent
+
+        root = Ob()
+        folder = Ob(root)
+        doc = Ob(folder)
+        self.policy.cache(doc)
+        self.policy.invalidate_cache_for(root)
+        self.assertEqual(len(self.policy._cache), 0)
+        self.assertEqual(self.policy._parents, {})
+        self.assertEqual(self.policy._children, {})
+
+    def test_invalidate_cache_for_unrelated(self):
+        root, folder, doc, other = self._makeTree()
+        self.policy.invalidate_cache_for(object())
+        self.assertEqual(len(self.policy._cache), 5)
+
+    def test_invalidate_cache_for_only_visits_subtree(self):
+        class Ob:
+            def __init__(self, parent=None):
+                self.__parent__ = parent
+
+        root = Ob()
+        folder = Ob(root)
+        doc = Ob(folder)
+        self.policy.cache(doc)
+
+        class Other:
+            walked = False
+
+            @property
+            def __parent__(self):
+                if self.walked:
+                    raise AssertionError('not in the subtree')
+
+        others = [Other() for i in range(10)]
+        for ob in others:
+            self.policy.cache(ob)
+        Other.walked = True
+        self.policy.invalidate_cache_for(folder)
+        self.assertEqual(
+            set(self.policy._cache), {id(ob) for ob in others})
+
+    def test_tree_follows_evictions(self):
+        import gc
+
+        class Ob:
+            def __init__(self, parent=None):
+                self.__parent__ = parent
+
+        root = Ob()
+        folder = Ob(root)
+        doc = Ob(folder)
+        other = Ob(root)
+        self.policy.cache_size = 2
+        self.policy.cache(doc)
+        self.policy.cache(other)
+        self.assertEqual(
+            self.policy._children[id(root)], {id(folder), id(other)})
+
+        # Evicting doc drops folder, which isn't needed anymore
+        temp = Ob(root)
+        self.policy.cache(temp)
+        self.assertEqual(
+            set(self.policy._parents), {id(root), id(other), id(temp)})
+        self.assertEqual(
+            self.policy._children[id(root)], {id(other), id(temp)})
+
+        # So does collecting an object
+        del temp
+        gc.collect()
+        self.assertEqual(set(self.policy._parents), {id(root), id(other)})
+        self.assertEqual(self.policy._children[id(root)], {id(other)})
+
+    def test_invalidate_cache_for_global(self):
+        self._makeTree()
+        self.policy.invalidate_cache_for(None)
+        self.assertEqual(len(self.policy._cache), 0)
+        self.assertEqual(self.policy._groups, {'bob': ()})
+
+    def test_invalidate_cache(self):
+        self._makeTree()
+        self.policy.invalidate_cache()
+        self.assertEqual(len(self.policy._cache), 0)
+        self.assertEqual(self.policy._groups, {})
+
     def test__findGroupsFor_seen(self):
         group_id = 'group'
 
@@ -167,6 +362,952 @@ class TestZopePolicy(CleanUp, unittest.TestCase):
             ()
         )
 
+    def _groupLookup(self, groups):
+        lookups = []
+
+        class Group:
+            def __init__(self, id):
+                self.groups = groups.get(id, ())
+
+        def getPrincipal(gid):
+            from zope.authentication.interfaces import PrincipalLookupError
+            lookups.append(gid)
+            if gid not in groups:
+                raise PrincipalLookupError(gid)
+            return Group(gid)
+
+        return getPrincipal, lookups
+
+    def test__findGroupsFor_shared_subgroups(self):
+        # A group reached along several paths is only looked up once and
+        # its groups are shared.
+        getPrincipal, lookups = self._groupLookup(
+            {'a': ('c',), 'b': ('c',), 'c': ('d',), 'd': ()})
+
+        class Principal:
+            groups = ('a', 'b')
+
+        groups = self.policy._findGroupsFor(Principal(), getPrincipal, [])
+        self.assertEqual(groups, (('a', (('c', (('d', ()),)),)),
+                                  ('b', (('c', (('d', ()),)),))))
+        self.assertIs(groups[0][1][0][1], groups[1][1][0][1])
+        self.assertEqual(sorted(lookups), ['a', 'b', 'c', 'd'])
+
+    def test__findGroupsFor_cycles_not_memoized(self):
+        # What a group contains depends on the path if a cycle was cut.
+        getPrincipal, lookups = self._groupLookup({'a': ('b',), 'b': ('a',)})
+
+        class Principal:
+            groups = ('a', 'b')
+
+        self.assertEqual(
+            self.policy._findGroupsFor(Principal(), getPrincipal, []),
+            (('a', (('b', ()),)), ('b', (('a', ()),))))
+
+    def test__findGroupsFor_LookupError_does_not_hide_groups(self):
+        getPrincipal, lookups = self._groupLookup(
+            {'a': ('missing',), 'b': ('a', 'missing')})
+
+        class Principal:
+            groups = ('a', 'b')
+
+        self.assertEqual(
+            self.policy._findGroupsFor(Principal(), getPrincipal, []),
+            (('a', ()), ('b', (('a', ()),))))
+        self.assertEqual(lookups.count('missing'), 1)
+
+    def test_shared_subgroups_decided_once(self):
+        calls = []
+        policy = self.policy
+        cached_prinper = policy.cached_prinper
+
+        def spy(parent, principal, groups, permission):
+            calls.append(principal)
+            return cached_prinper(parent, principal, groups, permission)
+
+        policy.cached_prinper = spy
+        shared = (('d', ()),)
+        groups = (('a', (('c', shared),)), ('b', (('c', shared),)))
+        self.assertIsNone(policy._group_based_cashed_prinper(
+            None, 'p', groups, 'perm'))
+        self.assertEqual(sorted(calls), ['a', 'b', 'c', 'd'])
+
+
+class Principal:
+
+    def __init__(self, id):
+        self.id = id
+        self.groups = []
+
+
+class Participation:
+    interaction = None
+
+    def __init__(self, principal):
+        self.principal = principal
+
+
+class PersistentOb:
+
+    def __init__(self, oid, parent=None):
+        self._p_oid = oid
+        self.__parent__ = parent
+
+
+@interface.implementer(IAttributeAnnotatable)
+class Annotatable:
+
+    def __init__(self, parent=None):
+        self.__parent__ = parent
+
+
+class TestSharedDecisionCache(CleanUp, unittest.TestCase):
+
+    def _makeOne(self, maxsize=100000):
+        return zopepolicy.SharedDecisionCache(maxsize)
+
+    def test_get_set(self):
+        cache = self._makeOne()
+        self.assertIsNone(cache.get('key'))
+        cache.set('key', True, securitymap.getGeneration())
+        self.assertTrue(cache.get('key'))
+
+    def test_set_computed_in_older_generation(self):
+        cache = self._makeOne()
+        generation = securitymap.getGeneration()
+        securitymap.SecurityMap().addCell('row', 'col', Allow)
+        cache.set('key', True, generation)
+        self.assertIsNone(cache.get('key'))
+
+    def test_grant_change_drops_decisions(self):
+        cache = self._makeOne()
+        cache.set('key', True, securitymap.getGeneration())
+        securitymap.SecurityMap().addCell('row', 'col', Allow)
+        self.assertIsNone(cache.get('key'))
+        cache.set('key', False, securitymap.getGeneration())
+        self.assertIs(cache.get('key'), False)
+
+    def test_maxsize(self):
+        cache = self._makeOne(2)
+        generation = securitymap.getGeneration()
+        cache.set('a', True, generation)
+        cache.set('b', True, generation)
+        cache.set('c', True, generation)
+        self.assertIsNone(cache.get('a'))
+        self.assertTrue(cache.get('c'))
+
+    def test_invalidate(self):
+        cache = self._makeOne()
+        cache.set('key', True, securitymap.getGeneration())
+        cache.invalidate()
+        self.assertIsNone(cache.get('key'))
+
+    def test_commit_bumps_generation(self):
+        import transaction
+        transaction.begin()
+        securitymap.SecurityMap().addCell('row', 'col', Allow)
+        generation = securitymap.getGeneration()
+        transaction.commit()
+        self.assertNotEqual(generation, securitymap.getGeneration())
+
+
+class TestZopePolicySharedCache(CleanUp, unittest.TestCase):
+
+    def setUp(self):
+        import transaction
+        super().setUp()
+        transaction.abort()
+        self.shared = zopepolicy.SharedDecisionCache()
+        zopepolicy.ZopeSecurityPolicy.shared_cache = self.shared
+        self.root = PersistentOb(b'\0')
+        self.ob = PersistentOb(b'\1', self.root)
+
+    def tearDown(self):
+        import transaction
+        transaction.abort()
+        zopepolicy.ZopeSecurityPolicy.shared_cache = None
+        super().tearDown()
+
+    def _makePolicy(self, principal_id='bob'):
+        policy = zopepolicy.ZopeSecurityPolicy()
+        policy.add(Participation(Principal(principal_id)))
+        return policy
+
+    def test_decisions_are_shared(self):
+        import transaction
+        principalPermissionManager.grantPermissionToPrincipal(
+            'P1', 'bob', False)
+        transaction.commit()
+        self.assertTrue(self._makePolicy().checkPermission('P1', self.ob))
+
+        policy = self._makePolicy()
+        policy._decision = None  # not called
+        self.assertTrue(policy.checkPermission('P1', self.ob))
+
+    def test_decisions_not_shared_between_principals(self):
+        principalPermissionManager.grantPermissionToPrincipal(
+            'P1', 'bob', False)
+        self.assertTrue(self._makePolicy().checkPermission('P1', self.ob))
+        self.assertFalse(
+            self._makePolicy('alice').checkPermission('P1', self.ob))
+
+    def test_grant_change_invalidates(self):
+        self.assertFalse(self._makePolicy().checkPermission('P1', self.ob))
+        principalPermissionManager.grantPermissionToPrincipal(
+            'P1', 'bob', False)
+        self.assertTrue(self._makePolicy().checkPermission('P1', self.ob))
+
+    def test_pending_changes_are_not_shared(self):
+        import transaction
+        self.assertFalse(self._makePolicy().checkPermission('P1', self.ob))
+        self.assertEqual(len(self.shared._data), 1)
+        principalPermissionManager.grantPermissionToPrincipal(
+            'P1', 'bob', False)
+        self.assertTrue(self._makePolicy().checkPermission('P1', self.ob))
+        self.assertNotIn(True, self.shared._data.values())
+        transaction.abort()
+        principalPermissionManager.unsetPermissionForPrincipal('P1', 'bob')
+        transaction.commit()
+        self.assertFalse(self._makePolicy().checkPermission('P1', self.ob))
+        self.assertEqual(len(self.shared._data), 1)
+
+    def test_abort_changes_generation(self):
+        import transaction
+        principalPermissionManager.grantPermissionToPrincipal(
+            'P1', 'bob', False)
+        generation = zopepolicy.getGeneration()
+        transaction.abort()
+        self.assertNotEqual(zopepolicy.getGeneration(), generation)
+
+    def test_deep_shared_groups(self):
+        # Groups sharing subgroups at every level would be a tree of
+        # 2 ** 40 groups if walked along every path.
+        groups = ()
+        for i in range(40):
+            groups = (('a%d' % i, groups), ('b%d' % i, groups))
+        policy = self._makePolicy()
+        self.assertFalse(
+            policy.cached_decision(self.ob, 'bob', groups, 'P1'))
+        (key, decision), = self.shared._data.items()
+        self.assertEqual(key[2], zopepolicy._groupsKey(groups))
+
+    def test_groups_key(self):
+        nested = (('g1', (('g2', ()), )), )
+        flat = (('g1', ()), ('g2', ()))
+        self.assertNotEqual(
+            zopepolicy._groupsKey(nested), zopepolicy._groupsKey(flat))
+        self.assertEqual(
+            zopepolicy._groupsKey(nested),
+            zopepolicy._groupsKey((('g1', (('g2', ()), )), )))
+
+    def test_stale_interaction_does_not_share(self):
+        policy = self._makePolicy()
+        principalPermissionManager.grantPermissionToPrincipal(
+            'P1', 'bob', False)
+        self.assertTrue(policy.checkPermission('P1', self.ob))
+        self.assertEqual(self.shared._data, {})
+
+    def test_transient_objects_are_not_shared(self):
+        ob = PersistentOb(None, self.root)
+        self.assertFalse(self._makePolicy().checkPermission('P1', ob))
+        self.assertEqual(self.shared._data, {})
+
+        # transient ancestors prevent sharing too
+        ob = PersistentOb(b'\2', PersistentOb(None, self.root))
+        self.assertFalse(self._makePolicy().checkPermission('P1', ob))
+        self.assertEqual(self.shared._data, {})
+
+
+class TestSharedGroupsCache(unittest.TestCase):
+
+    def _makeOne(self, maxsize=10000, ttl=300):
+        cache = zopepolicy.SharedGroupsCache(maxsize, ttl)
+        cache.now = 0
+        cache._clock = lambda: cache.now
+        self.auth = object()
+        return cache
+
+    def test_get_set(self):
+        cache = self._makeOne()
+        self.assertIsNone(cache.get(self.auth, 'bob', ['g1']))
+        cache.set(self.auth, 'bob', ['g1'], (('g1', ()), ))
+        self.assertEqual(cache.get(self.auth, 'bob', ['g1']), (('g1', ()), ))
+
+    def test_per_authentication_utility(self):
+        cache = self._makeOne()
+        cache.set(self.auth, 'bob', ['g1'], (('g1', ()), ))
+        self.assertIsNone(cache.get(object(), 'bob', ['g1']))
+        self.assertIsNotNone(cache.get(self.auth, 'bob', ['g1']))
+
+    def test_persistent_authentication_utility(self):
+        # Copies of a persistent utility loaded by other connections share
+        # their entries
+        auth, copy = PersistentOb(b'oid'), PersistentOb(b'oid')
+        cache = self._makeOne()
+        cache.set(auth, 'bob', ['g1'], (('g1', ()), ))
+        self.assertIsNotNone(cache.get(copy, 'bob', ['g1']))
+
+    def test_ttl(self):
+        cache = self._makeOne(ttl=10)
+        cache.set(self.auth, 'bob', ['g1'], (('g1', ()), ))
+        cache.now = 9
+        self.assertEqual(cache.get(self.auth, 'bob', ['g1']), (('g1', ()), ))
+        cache.now = 10
+        self.assertIsNone(cache.get(self.auth, 'bob', ['g1']))
+
+    def test_direct_groups_changed(self):
+        cache = self._makeOne()
+        cache.set(self.auth, 'bob', ['g1'], (('g1', ()), ))
+        self.assertIsNone(cache.get(self.auth, 'bob', ['g1', 'g2']))
+
+    def test_maxsize(self):
+        cache = self._makeOne(maxsize=2)
+        cache.set(self.auth, 'bob', ['g1'], (('g1', ()), ))
+        cache.set(self.auth, 'alice', ['g1'], (('g1', ()), ))
+        cache.get(self.auth, 'bob', ['g1'])
+        cache.set(self.auth, 'carol', ['g1'], (('g1', ()), ))
+        self.assertIsNone(cache.get(self.auth, 'alice', ['g1']))
+        self.assertIsNotNone(cache.get(self.auth, 'bob', ['g1']))
+        self.assertIsNotNone(cache.get(self.auth, 'carol', ['g1']))
+
+    def test_invalidate(self):
+        cache = self._makeOne()
+        cache.set(self.auth, 'bob', ['g1'], (('g1', (('g2', ()), )), ))
+        cache.set(self.auth, 'alice', ['g3'], (('g3', ()), ))
+        cache.set(self.auth, 'carol', ['g4'], (('g4', ()), ))
+
+        cache.invalidate('carol')
+        self.assertIsNone(cache.get(self.auth, 'carol', ['g4']))
+        self.assertIsNotNone(cache.get(self.auth, 'bob', ['g1']))
+
+        # Members of a group are dropped with it
+        cache.invalidate('g2')
+        self.assertIsNone(cache.get(self.auth, 'bob', ['g1']))
+        self.assertIsNotNone(cache.get(self.auth, 'alice', ['g3']))
+
+        cache.invalidate()
+        self.assertIsNone(cache.get(self.auth, 'alice', ['g3']))
+
+    def test_invalidate_deep_shared_groups(self):
+        cache = self._makeOne()
+        groups = ()
+        for i in range(40):
+            groups = (('a%d' % i, groups), ('b%d' % i, groups))
+        cache.set(self.auth, 'bob', ['a39', 'b39'], groups)
+        cache.invalidate('carol')
+        self.assertIsNotNone(cache.get(self.auth, 'bob', ['a39', 'b39']))
+        cache.invalidate('b0')
+        self.assertIsNone(cache.get(self.auth, 'bob', ['a39', 'b39']))
+
+
+class TestZopePolicyGroupsCache(CleanUp, unittest.TestCase):
+
+    def setUp(self):
+        from zope.authentication.interfaces import IAuthentication
+        from zope.component import provideUtility
+
+        from zope.securitypolicy.tests import DummyPrincipalRegistry
+
+        super().setUp()
+        self.lookups = []
+        auth = DummyPrincipalRegistry()
+        getPrincipal = auth.getPrincipal
+
+        def counting(id):
+            self.lookups.append(id)
+            return getPrincipal(id)
+
+        auth.getPrincipal = counting
+        auth.definePrincipal('g1').groups = ['g2']
+        auth.definePrincipal('g2').groups = []
+        provideUtility(auth, IAuthentication)
+        zopepolicy.ZopeSecurityPolicy.groups_cache = (
+            zopepolicy.SharedGroupsCache())
+        self.principal = Principal('bob')
+        self.principal.groups = ['g1']
+
+    def tearDown(self):
+        zopepolicy.ZopeSecurityPolicy.groups_cache = None
+        super().tearDown()
+
+    def test_groups_are_shared(self):
+        groups = (('g1', (('g2', ()), )), )
+        policy = zopepolicy.ZopeSecurityPolicy()
+        self.assertEqual(policy._groupsFor(self.principal), groups)
+        self.assertEqual(self.lookups, ['g1', 'g2'])
+
+        policy = zopepolicy.ZopeSecurityPolicy()
+        self.assertEqual(policy._groupsFor(self.principal), groups)
+        self.assertEqual(self.lookups, ['g1', 'g2'])
+
+        zopepolicy.ZopeSecurityPolicy.groups_cache.invalidate('bob')
+        policy = zopepolicy.ZopeSecurityPolicy()
+        self.assertEqual(policy._groupsFor(self.principal), groups)
+        self.assertEqual(self.lookups, ['g1', 'g2', 'g1', 'g2'])
+
+    def test_groups_of_other_authentication_utilities(self):
+        # Such as that of another site
+        from zope.authentication.interfaces import IAuthentication
+        from zope.component import provideUtility
+
+        from zope.securitypolicy.tests import DummyPrincipalRegistry
+
+        policy = zopepolicy.ZopeSecurityPolicy()
+        self.assertEqual(
+            policy._groupsFor(self.principal), (('g1', (('g2', ()), )), ))
+
+        auth = DummyPrincipalRegistry()
+        auth.definePrincipal('g1').groups = []
+        provideUtility(auth, IAuthentication)
+        policy = zopepolicy.ZopeSecurityPolicy()
+        self.assertEqual(policy._groupsFor(self.principal), (('g1', ()), ))
+
+    def test_principals_without_groups(self):
+        self.principal.groups = []
+        policy = zopepolicy.ZopeSecurityPolicy()
+        self.assertEqual(policy._groupsFor(self.principal), ())
+        self.assertEqual(
+            len(zopepolicy.ZopeSecurityPolicy.groups_cache._data), 0)
+
+
+class TestCheckPermissions(CleanUp, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.policy = zopepolicy.ZopeSecurityPolicy()
+        self.ob = PersistentOb(None, PersistentOb(None))
+
+    def test_no_participations(self):
+        self.assertEqual(
+            self.policy.checkPermissions(['P1', 'P2'], self.ob),
+            {'P1': True, 'P2': True})
+
+    def test_checkPermissions(self):
+        from zope.security.checker import CheckerPublic
+        from zope.security.checker import ProxyFactory
+        principalPermissionManager.grantPermissionToPrincipal(
+            'P1', 'bob', False)
+        rolePermissionManager.grantPermissionToRole('P2', 'R1', False)
+        principalRoleManager.assignRoleToPrincipal('R1', 'bob', False)
+        self.policy.add(Participation(Principal('bob')))
+
+        self.assertEqual(
+            self.policy.checkPermissions(
+                ['P1', 'P2', 'P3', CheckerPublic], ProxyFactory(self.ob)),
+            {'P1': True, 'P2': True, 'P3': False, CheckerPublic: True})
+
+    def test_all_principals_need_the_permission(self):
+        from zope.security.management import system_user
+
+        class SystemParticipation:
+            principal = system_user
+            interaction = None
+
+        principalPermissionManager.grantPermissionToPrincipal(
+            'P1', 'bob', False)
+        principalPermissionManager.grantPermissionToPrincipal(
+            'P1', 'alice', False)
+        principalPermissionManager.grantPermissionToPrincipal(
+            'P2', 'alice', False)
+        self.policy.add(SystemParticipation())
+        self.policy.add(Participation(Principal('bob')))
+        self.policy.add(Participation(Principal('alice')))
+        self.policy.add(Participation(Principal('alice')))
+
+        self.assertEqual(
+            self.policy.checkPermissions(['P1', 'P2'], self.ob),
+            {'P1': True, 'P2': False})
+
+    def test_groups_are_looked_up_once(self):
+        calls = []
+        groupsFor = self.policy._groupsFor
+
+        def _groupsFor(principal):
+            calls.append(principal.id)
+            return groupsFor(principal)
+
+        self.policy._groupsFor = _groupsFor
+        self.policy.add(Participation(Principal('bob')))
+        self.policy.checkPermissions(['P1', 'P2', 'P3'], self.ob)
+        self.assertEqual(calls, ['bob'])
+
+    def test_principal_roles_are_computed_once(self):
+        calls = []
+        cached_principal_roles = self.policy.cached_principal_roles
+
+        def counting(parent, principal):
+            calls.append(parent)
+            return cached_principal_roles(parent, principal)
+
+        rolePermissionManager.grantPermissionToRole('P1', 'R1', False)
+        rolePermissionManager.grantPermissionToRole('P2', 'R1', False)
+        self.policy.cached_principal_roles = counting
+        self.policy.add(Participation(Principal('bob')))
+        self.assertEqual(
+            self.policy.checkPermissions(['P1', 'P2'], self.ob),
+            {'P1': False, 'P2': False})
+        self.assertEqual(calls.count(self.ob), 1)
+
+
+class TestFilterAllowed(CleanUp, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        provideAdapter(AttributeAnnotations)
+        provideAdapter(AnnotationPrincipalPermissionManager, (IAnnotatable,),
+                       IPrincipalPermissionManager)
+        provideAdapter(AnnotationPrincipalRoleManager, (IAnnotatable,),
+                       IPrincipalRoleManager)
+        provideAdapter(AnnotationRolePermissionManager, (IAnnotatable,),
+                       IRolePermissionManager)
+        self.policy = zopepolicy.ZopeSecurityPolicy()
+        self.policy.add(Participation(Principal('bob')))
+        self.folder = Annotatable()
+        self.items = [Annotatable(self.folder) for i in range(5)]
+
+    def test_filterAllowed(self):
+        IRolePermissionManager(self.folder).grantPermissionToRole('P1', 'R1')
+        IPrincipalRoleManager(self.items[1]).assignRoleToPrincipal(
+            'R1', 'bob')
+        IPrincipalPermissionManager(
+            self.items[3]).grantPermissionToPrincipal('P1', 'bob')
+        self.assertEqual(
+            self.policy.filterAllowed('P1', self.items),
+            [self.items[1], self.items[3]])
+
+    def test_filterAllowed_inherited(self):
+        IPrincipalPermissionManager(
+            self.folder).grantPermissionToPrincipal('P1', 'bob')
+        IPrincipalPermissionManager(
+            self.items[2]).denyPermissionToPrincipal('P1', 'bob')
+        self.assertEqual(
+            self.policy.filterAllowed('P1', self.items),
+            self.items[:2] + self.items[3:])
+
+    def test_iterAllowed_is_lazy_and_keeps_proxies(self):
+        from zope.security.checker import ProxyFactory
+        IPrincipalPermissionManager(
+            self.folder).grantPermissionToPrincipal('P1', 'bob')
+        proxied = [ProxyFactory(item) for item in self.items]
+        it = self.policy.iterAllowed('P1', iter(proxied))
+        self.assertIs(next(it), proxied[0])
+        self.assertEqual(list(it), proxied[1:])
+
+    def test_iterAllowed_public(self):
+        from zope.security.checker import CheckerPublic
+        self.assertEqual(
+            self.policy.filterAllowed(CheckerPublic, self.items),
+            self.items)
+
+    def test_ancestors_are_walked_once(self):
+        calls = []
+
+        def counting(context):
+            calls.append(context)
+            return AnnotationPrincipalRoleManager(context)
+
+        provideAdapter(counting, (IAnnotatable,), IPrincipalRoleManager)
+        IRolePermissionManager(self.folder).grantPermissionToRole('P1', 'R1')
+        self.policy.filterAllowed('P1', self.items)
+        self.assertEqual(calls.count(self.folder), 1)
+        self.assertEqual(calls.count(self.items[0]), 1)
+
+        self.policy.filterAllowed('P1', self.items)
+        self.assertEqual(calls.count(self.folder), 1)
+        self.assertEqual(calls.count(self.items[0]), 2)
+
+    def test_objects_are_not_cached(self):
+        self.policy.filterAllowed('P1', self.items)
+        self.assertNotIn(id(self.items[0]), self.policy._cache)
+        self.assertIn(id(self.folder), self.policy._cache)
+
+        # but objects cached before stay cached
+        self.policy.checkPermission('P1', self.items[0])
+        self.policy.filterAllowed('P1', self.items)
+        self.assertIn(id(self.items[0]), self.policy._cache)
+
+
+class TestGrantChanges(CleanUp, unittest.TestCase):
+    # Grant changes are seen by the current interaction
+
+    def setUp(self):
+        from zope.security.management import setSecurityPolicy
+        super().setUp()
+        provideAdapter(AttributeAnnotations)
+        provideAdapter(AnnotationPrincipalPermissionManager, (IAnnotatable,),
+                       IPrincipalPermissionManager)
+        setSecurityPolicy(zopepolicy.ZopeSecurityPolicy)
+        newInteraction(Participation(Principal('bob')))
+        self.policy = queryInteraction()
+
+    def _grant(self, ob):
+        IPrincipalPermissionManager(ob).grantPermissionToPrincipal(
+            'P1', 'bob')
+
+    def test_grant_on_new_parent(self):
+        root = Annotatable()
+        old, new = Annotatable(root), Annotatable(root)
+        ob = Annotatable(old)
+        child = Annotatable(ob)
+        self.assertFalse(self.policy.checkPermission('P1', child))
+        self.assertFalse(self.policy.checkPermission('P1', ob))
+        ob.__parent__ = new
+        self._grant(new)
+        self.assertTrue(self.policy.checkPermission('P1', child))
+        self.assertTrue(self.policy.checkPermission('P1', ob))
+
+    def test_grant_on_new_parent_later(self):
+        # The move and the grant happen after other grant changes
+        root = Annotatable()
+        old, new = Annotatable(root), Annotatable(root)
+        ob = Annotatable(old)
+        self.assertFalse(self.policy.checkPermission('P1', ob))
+        self._grant(Annotatable())
+        self.assertFalse(self.policy.checkPermission('P1', old))
+        ob.__parent__ = new
+        self._grant(new)
+        self.assertTrue(self.policy.checkPermission('P1', ob))
+
+    def test_grant_through_other_proxy(self):
+        from zope.location import LocationProxy
+        root = Annotatable()
+        ob = Annotatable()
+        self.assertFalse(
+            self.policy.checkPermission('P1', LocationProxy(ob, root)))
+        proxy = LocationProxy(ob, root)
+        self.assertFalse(self.policy.checkPermission('P1', proxy))
+        self._grant(LocationProxy(ob, root))
+        self.assertTrue(self.policy.checkPermission('P1', proxy))
+        self.assertTrue(self.policy.checkPermission('P1', ob))
+
+    def test_unrelated_grants_keep_entries(self):
+        root = Annotatable()
+        ob = Annotatable(root)
+        self.assertFalse(self.policy.checkPermission('P1', ob))
+        entry = self.policy.cache(ob)
+        self._grant(Annotatable(root))
+        self.assertIs(self.policy.cache(ob), entry)
+
+
+class TestIterSettingsForObject(CleanUp, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        provideAdapter(AttributeAnnotations)
+        provideAdapter(AnnotationPrincipalPermissionManager, (IAnnotatable,),
+                       IPrincipalPermissionManager)
+        provideAdapter(AnnotationPrincipalRoleManager, (IAnnotatable,),
+                       IPrincipalRoleManager)
+        provideAdapter(AnnotationRolePermissionManager, (IAnnotatable,),
+                       IRolePermissionManager)
+        self.root = Annotatable()
+        self.root.__name__ = 'root'
+        self.ob = Annotatable(self.root)
+        self.ob.__name__ = 'ob'
+        IPrincipalRoleManager(self.ob).assignRoleToPrincipal('R1', 'bob')
+        IPrincipalPermissionManager(self.ob).denyPermissionToPrincipal(
+            'P1', 'alice')
+        IRolePermissionManager(self.root).grantPermissionToRole('P1', 'R1')
+        principalPermissionManager.grantPermissionToPrincipal(
+            'P2', 'bob', False)
+
+    def _settings(self, **kw):
+        return list(zopepolicy.iterSettingsForObject(self.ob, **kw))
+
+    def test_all(self):
+        self.assertEqual(self._settings(), [
+            ('ob', 'principalPermissions', 'alice', 'P1', Deny),
+            ('ob', 'principalRoles', 'bob', 'R1', Allow),
+            ('root', 'rolePermissions', 'R1', 'P1', Allow),
+            ('global settings', 'principalPermissions', 'bob', 'P2', Allow),
+        ])
+
+    def test_filters(self):
+        self.assertEqual(self._settings(principal='bob'), [
+            ('ob', 'principalRoles', 'bob', 'R1', Allow),
+            ('global settings', 'principalPermissions', 'bob', 'P2', Allow),
+        ])
+        self.assertEqual(self._settings(permission='P1'), [
+            ('ob', 'principalPermissions', 'alice', 'P1', Deny),
+            ('root', 'rolePermissions', 'R1', 'P1', Allow),
+        ])
+        self.assertEqual(self._settings(role='R1'), [
+            ('ob', 'principalRoles', 'bob', 'R1', Allow),
+            ('root', 'rolePermissions', 'R1', 'P1', Allow),
+        ])
+        self.assertEqual(self._settings(principal='bob', permission='P2'), [
+            ('global settings', 'principalPermissions', 'bob', 'P2', Allow),
+        ])
+        self.assertEqual(self._settings(principal='bob', permission='P1'),
+                         [])
+
+    def test_pagination(self):
+        settings = self._settings()
+        self.assertEqual(self._settings(offset=1, limit=2), settings[1:3])
+        self.assertEqual(self._settings(offset=3), settings[3:])
+        self.assertEqual(self._settings(limit=0), [])
+
+    def test_lazy(self):
+        settings = zopepolicy.iterSettingsForObject(self.ob)
+        self.assertEqual(next(settings)[0], 'ob')
+        # changing grants not reached yet is seen
+        IRolePermissionManager(self.root).denyPermissionToRole('P3', 'R2')
+        self.assertIn(('root', 'rolePermissions', 'R2', 'P3', Deny),
+                      list(settings))
+
+    def test_maps_without_iter_methods(self):
+        from zope.securitypolicy.interfaces import IPrincipalRoleMap
+
+        @interface.implementer(IPrincipalRoleMap)
+        class EditorMap:
+            def __init__(self, context):
+                pass
+
+            def getPrincipalsForRole(self, role_id):
+                return [('carol', Allow)] if role_id == 'Editor' else []
+
+            def getRolesForPrincipal(self, principal_id):
+                return [('Editor', Allow)] if principal_id == 'carol' else []
+
+            def getPrincipalsAndRoles(self):
+                return [('Editor', 'carol', Allow)]
+
+        provideAdapter(EditorMap, (IAnnotatable,), IPrincipalRoleMap)
+        expected = [
+            ('ob', 'principalRoles', 'carol', 'Editor', Allow),
+            ('root', 'principalRoles', 'carol', 'Editor', Allow),
+        ]
+        self.assertEqual(self._settings(principal='carol'), expected)
+        self.assertEqual(self._settings(role='Editor'), expected)
+        self.assertEqual(
+            [s for s in self._settings() if s[1] == 'principalRoles'],
+            expected)
+
+
+class TestRoleOverlay(unittest.TestCase):
+
+    def _makeOne(self, changes, inherited=None):
+        return zopepolicy.RoleOverlay(changes, inherited)
+
+    def test_mapping(self):
+        base = self._makeOne({'R1': True, 'R2': False})
+        overlay = self._makeOne(
+            {'R2': True, 'R3': False, 'R1': zopepolicy._removed}, base)
+        self.assertEqual(overlay, {'R2': True, 'R3': False})
+        self.assertEqual(len(overlay), 2)
+        self.assertEqual(sorted(overlay), ['R2', 'R3'])
+        self.assertNotIn('R1', overlay)
+        self.assertIn('R3', overlay)
+        self.assertIsNone(overlay.get('R4'))
+        self.assertTrue(overlay['R2'])
+        self.assertEqual(base, {'R1': True, 'R2': False})
+        self.assertEqual(repr(base), "RoleOverlay({'R1': True, 'R2': False})")
+
+    def test_empty(self):
+        base = self._makeOne({'R1': 1})
+        overlay = self._makeOne({'R1': zopepolicy._removed}, base)
+        self.assertFalse(overlay)
+        self.assertEqual(list(overlay), [])
+        self.assertRaises(KeyError, overlay.__getitem__, 'R1')
+        self.assertEqual(
+            len(self._makeOne({'R2': zopepolicy._removed}, base)), 1)
+
+    def test_deep_overlays_are_flattened(self):
+        overlay = self._makeOne({'R0': 1})
+        for i in range(1, 100):
+            overlay = self._makeOne(
+                {'R%d' % i: 1, 'R%d' % (i - 1): zopepolicy._removed},
+                overlay)
+            self.assertLessEqual(overlay._depth, overlay.max_depth)
+        self.assertEqual(overlay, {'R99': 1})
+        self.assertEqual(len(overlay), 1)
+
+
+class TestDeepTrees(CleanUp, unittest.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        provideAdapter(AttributeAnnotations)
+        provideAdapter(AnnotationPrincipalPermissionManager, (IAnnotatable,),
+                       IPrincipalPermissionManager)
+        provideAdapter(AnnotationPrincipalRoleManager, (IAnnotatable,),
+                       IPrincipalRoleManager)
+        provideAdapter(AnnotationRolePermissionManager, (IAnnotatable,),
+                       IRolePermissionManager)
+        self.policy = zopepolicy.ZopeSecurityPolicy()
+        self.policy.add(Participation(Principal('bob')))
+        # Deeper than we could recurse
+        self.depth = sys.getrecursionlimit() * 2
+        self.root = ob = Annotatable()
+        self.obs = []
+        for i in range(self.depth):
+            ob = Annotatable(ob)
+            self.obs.append(ob)
+        IRolePermissionManager(self.root).grantPermissionToRole('P1', 'R1')
+        IPrincipalRoleManager(self.obs[10]).assignRoleToPrincipal('R1', 'bob')
+        IPrincipalPermissionManager(
+            self.root).denyPermissionToPrincipal('P2', 'bob')
+        principalPermissionManager.grantPermissionToPrincipal(
+            'P2', 'bob', False)
+
+    def tearDown(self):
+        zopepolicy.ZopeSecurityPolicy.role_masks = False
+        zopepolicy.ZopeSecurityPolicy.use_grant_info = False
+        super().tearDown()
+
+    def _check(self):
+        leaf = self.obs[-1]
+        self.assertTrue(self.policy.checkPermission('P1', leaf))
+        self.assertFalse(self.policy.checkPermission('P2', leaf))
+        self.assertFalse(self.policy.checkPermission('P3', leaf))
+        self.assertFalse(self.policy.checkPermission('P1', self.obs[5]))
+
+    def test_deep_tree(self):
+        self._check()
+
+    def test_deep_tree_role_masks(self):
+        self.policy.role_masks = True
+        self._check()
+
+    def test_all_levels_are_cached(self):
+        self._check()
+        middle = self.policy.cache(self.obs[self.depth // 2])
+        self.assertIs(middle.prin['bob']['P2'], False)
+        self.assertEqual(middle.roles['P1'], {'R1': 1})
+        self.assertTrue(middle.principal_roles['bob']['R1'])
+
+    def test_levels_are_looked_up_once(self):
+        # All walks share the maps and parents of the levels they pass
+        from collections import Counter
+
+        from zope.securitypolicy.interfaces import IPrincipalRoleMap
+        from zope.securitypolicy.interfaces import IRolePermissionMap
+
+        lookups = Counter()
+
+        def counting(factory, iface):
+            def adapter(context):
+                lookups[iface, id(context)] += 1
+                return factory(context)
+            provideAdapter(adapter, (IAnnotatable,), iface)
+
+        counting(AnnotationPrincipalPermissionManager,
+                 zopepolicy.IPrincipalPermissionMap)
+        counting(AnnotationPrincipalRoleManager, IPrincipalRoleMap)
+        counting(AnnotationRolePermissionManager, IRolePermissionMap)
+        self._check()
+        self.assertGreater(len(lookups), self.depth)
+        # Only maps with grants are looked up again
+        self.assertEqual(
+            {key: count for key, count in lookups.items() if count > 1},
+            {(zopepolicy.IPrincipalPermissionMap, id(self.root)): 3,
+             (IRolePermissionMap, id(self.root)): 2})
+
+    def test_levels_share_inherited_roles(self):
+        self._check()
+        cache = self.policy.cache
+        roles = cache(self.obs[-1]).roles['P1']
+        self.assertIs(cache(self.obs[0]).roles['P1'], roles)
+        self.assertIs(cache(self.root).roles['P1'], roles)
+        principal_roles = cache(self.obs[-1]).principal_roles['bob']
+        self.assertIs(cache(self.obs[10]).principal_roles['bob'],
+                      principal_roles)
+        self.assertIsNot(cache(self.obs[9]).principal_roles['bob'],
+                         principal_roles)
+
+    def test_grant_info(self):
+        provideAdapter(AnnotationGrantInfo, (IAnnotatable,), IGrantInfo)
+        self.policy.use_grant_info = True
+        self._check()
+        cache = self.policy.cache
+        self.assertIsInstance(cache(self.root).grant_info,
+                              AnnotationGrantInfo)
+        # Levels without grants are skipped
+        self.assertIs(cache(self.obs[0]).grant_info, False)
+        self.assertIsInstance(cache(self.obs[10]).grant_info,
+                              AnnotationGrantInfo)
+
+    def test_grant_info_not_used_by_default(self):
+        provideAdapter(AnnotationGrantInfo, (IAnnotatable,), IGrantInfo)
+        self._check()
+        self.assertIsNone(self.policy.cache(self.root).grant_info)
+
+    def test_grant_info_not_used_by_default_for_other_maps(self):
+        from zope.securitypolicy.interfaces import IPrincipalRoleMap
+
+        @interface.implementer(IPrincipalRoleMap)
+        class EditorMap:
+            def __init__(self, context):
+                pass
+
+            def getRolesForPrincipal(self, principal_id):
+                return [('Editor', Allow)]
+
+        provideAdapter(AnnotationGrantInfo, (IAnnotatable,), IGrantInfo)
+        provideAdapter(EditorMap, (IAnnotatable,), IPrincipalRoleMap)
+        rolePermissionManager.grantPermissionToRole('P4', 'Editor', False)
+        self.assertTrue(self.policy.checkPermission('P4', self.obs[-1]))
+
+    def test_grant_info_sees_changes(self):
+        from zope.security.management import setSecurityPolicy
+        provideAdapter(AnnotationGrantInfo, (IAnnotatable,), IGrantInfo)
+        zopepolicy.ZopeSecurityPolicy.use_grant_info = True
+        setSecurityPolicy(zopepolicy.ZopeSecurityPolicy)
+        newInteraction(Participation(Principal('bob')))
+        self.policy = queryInteraction()
+        self._check()
+        IPrincipalPermissionManager(
+            self.obs[0]).grantPermissionToPrincipal('P3', 'bob')
+        self.assertTrue(self.policy.checkPermission('P3', self.obs[-1]))
+
+    def test_local_grants_marker(self):
+        from zope.securitypolicy.interfaces import IHasLocalGrants
+        self.policy.local_grants_marker = True
+        self._check()
+        self.assertIs(self.policy.cache(self.obs[0]).grant_info, False)
+        self.assertTrue(IHasLocalGrants.providedBy(self.obs[10]))
+
+        # Objects without the marker are not looked at
+        self.policy.invalidate_cache()
+        interface.noLongerProvides(self.obs[10], IHasLocalGrants)
+        self.assertFalse(
+            self.policy.checkPermission('P1', self.obs[-1]))
+
+    def test_local_grants_marker_unmarkable(self):
+        # Objects that can't be marked are looked at all the same
+        from zope.annotation.interfaces import IAnnotations
+
+        from zope.securitypolicy.interfaces import IHasLocalGrants
+
+        @interface.implementer(IAnnotatable)
+        class Slotted:
+            __slots__ = ('__parent__', 'annotations')
+
+            def __init__(self, parent):
+                self.__parent__ = parent
+                self.annotations = {}
+
+            def __conform__(self, iface):
+                if iface is IAnnotations:
+                    return self.annotations
+
+        self.policy.local_grants_marker = True
+        ob = Slotted(self.obs[-1])
+        IPrincipalPermissionManager(ob).denyPermissionToPrincipal('P1', 'bob')
+        self.assertFalse(IHasLocalGrants.providedBy(ob))
+        self.assertFalse(self.policy.checkPermission('P1', ob))
+        self.assertTrue(self.policy.checkPermission('P1', self.obs[-1]))
+
+    def test_persistent_path(self):
+        ob = None
+        for i in range(self.depth):
+            ob = PersistentOb(i, ob)
+        path = self.policy._persistent_path(ob, self.policy.cache(ob))
+        self.assertEqual(path, tuple(reversed(range(self.depth))))
+        parent = ob.__parent__
+        self.assertEqual(
+            self.policy.cache(parent).persistent_path, path[1:])
+
 
 def setUp(test):
     componentSetUp()
@@ -181,10 +1322,24 @@ def setUp(test):
     provideAdapter(AnnotationGrantInfo, (IAnnotatable,), IGrantInfo)
 
 
+def setUpRoleMasks(test):
+    setUp(test)
+    zopepolicy.ZopeSecurityPolicy.role_masks = True
+
+
+def tearDownRoleMasks(test):
+    zopepolicy.ZopeSecurityPolicy.role_masks = False
+    componentTearDown(test)
+
+
 def test_suite():
     return unittest.TestSuite((
         DocFileSuite('zopepolicy.txt',
                      package='zope.securitypolicy',
                      setUp=setUp, tearDown=componentTearDown),
+        # the same rules apply when deciding on role masks
+        DocFileSuite('zopepolicy.txt',
+                     package='zope.securitypolicy',
+                     setUp=setUpRoleMasks, tearDown=tearDownRoleMasks),
         unittest.defaultTestLoader.loadTestsFromName(__name__)
     ))
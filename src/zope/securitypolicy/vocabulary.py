@@ -17,6 +17,8 @@ This vocabulary provides role IDs.
 """
 __docformat__ = 'restructuredtext'
 
+import weakref
+
 import zope.component
 from zope.interface import implementer
 from zope.interface import provider
@@ -25,7 +27,12 @@ from zope.schema.vocabulary import SimpleTerm
 from zope.schema.vocabulary import SimpleVocabulary
 
 from zope.securitypolicy.interfaces import IGrantVocabulary
-from zope.securitypolicy.interfaces import IRole
+from zope.securitypolicy.role import getRoleIds
+
+
+# The role ids (see `getRoleIds`) and the terms made for them, by site
+# manager
+_roleTerms = weakref.WeakKeyDictionary()
 
 
 @provider(IVocabularyFactory)
@@ -62,15 +69,34 @@ class RoleIdsVocabulary(SimpleVocabulary):
     >>> vocab.getTermByToken('b_id').value
     'b_id'
 
+    The terms are shared by the vocabularies of a site manager until the
+    roles defined change:
+
+    >>> other = registry.get(None, 'Role Ids')
+    >>> other.getTermByToken('a_id') is vocab.getTermByToken('a_id')
+    True
+
+    >>> provideUtility(Role('c_id','c_title'), IRole, 'c_id')
+    >>> other = registry.get(None, 'Role Ids')
+    >>> other.getTermByToken('c_id').value
+    'c_id'
+    >>> other.getTermByToken('a_id') is vocab.getTermByToken('a_id')
+    False
+
     >>> tearDown()
 
     """
 
     def __init__(self, context):
-        terms = []
-        roles = zope.component.getUtilitiesFor(IRole, context)
-        for name, role in roles:
-            terms.append(SimpleTerm(name, name, name))
+        sm = zope.component.getSiteManager(context)
+        role_ids = getRoleIds(sm)
+        cached = _roleTerms.get(sm)
+        if cached is not None and cached[0] is role_ids:
+            terms = cached[1]
+        else:
+            terms = tuple(
+                SimpleTerm(name, name, name) for name in role_ids)
+            _roleTerms[sm] = role_ids, terms
         super().__init__(terms)
 
 
@@ -78,3 +104,14 @@ class RoleIdsVocabulary(SimpleVocabulary):
 @implementer(IGrantVocabulary)
 class GrantVocabulary(SimpleVocabulary):
     """A vocabular for getting the RadioWidget via the Choice field."""
+
+
+# Register our cleanup with Testing.CleanUp to make writing unit tests
+# simpler.
+try:
+    from zope.testing.cleanup import addCleanUp
+except ModuleNotFoundError:  # pragma: no cover
+    pass
+else:
+    addCleanUp(_roleTerms.clear)
+    del addCleanUp
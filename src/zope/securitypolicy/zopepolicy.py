@@ -13,11 +13,19 @@
 ##############################################################################
 """Define Zope's default security policy
 """
+import hashlib
+import itertools
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from collections.abc import Mapping
 
 import zope.interface
 from zope.authentication.interfaces import IAuthentication
 from zope.authentication.interfaces import PrincipalLookupError
 from zope.component import getUtility
+from zope.proxy import removeAllProxies
 from zope.security.checker import CheckerPublic
 from zope.security.interfaces import ISecurityPolicy
 from zope.security.management import system_user
@@ -26,18 +34,27 @@ from zope.security.simplepolicies import ParanoidSecurityPolicy
 
 from zope.securitypolicy.interfaces import Allow
 from zope.securitypolicy.interfaces import Deny
+from zope.securitypolicy.interfaces import IGrantInfo
+from zope.securitypolicy.interfaces import IHasLocalGrants
 from zope.securitypolicy.interfaces import IPrincipalPermissionMap
 from zope.securitypolicy.interfaces import IPrincipalRoleMap
 from zope.securitypolicy.interfaces import IRolePermissionMap
 from zope.securitypolicy.interfaces import Unset
 from zope.securitypolicy.principalpermission import principalPermissionManager
 from zope.securitypolicy.principalrole import principalRoleManager
+from zope.securitypolicy.rolemask import roleBit
 from zope.securitypolicy.rolepermission import rolePermissionManager
+from zope.securitypolicy.securitymap import canMarkLocalGrants
+from zope.securitypolicy.securitymap import getGeneration
+from zope.securitypolicy.securitymap import hasPendingChanges
+from zope.securitypolicy.securitymap import internId
 
 
 globalPrincipalPermissionSetting = principalPermissionManager.getSetting
 globalRolesForPermission = rolePermissionManager.getRolesForPermission
 globalRolesForPrincipal = principalRoleManager.getRolesForPrincipal
+globalRoleMaskForPermission = rolePermissionManager.getRoleMaskForPermission
+globalRoleMasksForPrincipal = principalRoleManager.getRoleMasksForPrincipal
 SettingAsBoolean = {Allow: True, Deny: False, Unset: None, None: None}
 
 
@@ -45,23 +62,461 @@ class CacheEntry:
     pass
 
 
+# Marks a role that a RoleOverlay removes from the roles it inherits.
+_removed = object()
+
+
+class RoleOverlay(Mapping):
+    """Roles of an object, sharing those it inherits.
+
+    A level of an object tree usually changes few of the roles it
+    inherits from its parent, so it only stores its `changes`, in which
+    `_removed` marks roles it takes away, on top of the `inherited`
+    overlay.  Every `max_depth` levels the inherited roles are flattened
+    into a new base, so that lookups stay cheap in deep trees.
+    """
+
+    __slots__ = ('_inherited', '_changes', '_depth', '_len')
+
+    max_depth = 8
+
+    def __init__(self, changes, inherited=None):
+        if inherited is not None and inherited._depth >= self.max_depth:
+            base = dict(inherited.items())
+            for role, value in changes.items():
+                if value is _removed:
+                    base.pop(role, None)
+                else:
+                    base[role] = value
+            changes, inherited = base, None
+
+        self._changes = changes
+        self._inherited = inherited
+        if inherited is None:
+            self._depth = 0
+            self._len = len(changes)
+        else:
+            self._depth = inherited._depth + 1
+            size = len(inherited)
+            for role, value in changes.items():
+                if value is _removed:
+                    size -= role in inherited
+                elif role not in inherited:
+                    size += 1
+            self._len = size
+
+    def __getitem__(self, role):
+        overlay = self
+        while overlay is not None:
+            value = overlay._changes.get(role, _removed)
+            if value is not _removed:
+                return value
+            if role in overlay._changes:
+                break
+            overlay = overlay._inherited
+        raise KeyError(role)
+
+    def __iter__(self):
+        seen = set()
+        overlay = self
+        while overlay is not None:
+            for role, value in overlay._changes.items():
+                if role not in seen:
+                    seen.add(role)
+                    if value is not _removed:
+                        yield role
+            overlay = overlay._inherited
+
+    def __len__(self):
+        return self._len
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, dict(self.items()))
+
+
+class _StrongRef:
+    # Stands in for a weak reference to objects that don't support them
+    __slots__ = ('ob', )
+
+    def __init__(self, ob):
+        self.ob = ob
+
+    def __call__(self):
+        return self.ob
+
+
+# Key under which _findGroupsFor notes in its memo that a cycle was skipped.
+_skipped = object()
+
+
+def _forget(cache, key, policy=None):
+    # Return a weak reference callback dropping the cache entry for an
+    # object that went away.  `policy` is a weak reference to the policy
+    # whose tree of cached objects the object is then removed from.
+    def forget(ref):
+        entry = cache.get(key)
+        if entry is not None and entry[1] is ref:
+            del cache[key]
+            owner = policy() if policy is not None else None
+            if owner is not None and owner._cache is cache:
+                owner._unlink(key)
+    return forget
+
+
+class SharedDecisionCache:
+    """Process-wide cache of security decisions.
+
+    Decisions are keyed by the persistent identity of an object and its
+    ancestors, the principal and its groups, and the permission.  The
+    whole cache is dropped when the grant generation changes, that is,
+    whenever a security map is modified in this process or a
+    transaction that modified one commits or aborts.  Decisions are
+    neither shared nor looked up while the current transaction has
+    modified security maps.
+
+    Grant changes committed by other processes are not noticed; call
+    `invalidate` when they must be seen immediately.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self.invalidate()
+
+    def invalidate(self):
+        with self._lock:
+            self._data = {}
+            self._generation = getGeneration()
+
+    def get(self, key):
+        if self._generation != getGeneration():
+            return None
+        return self._data.get(key)
+
+    def set(self, key, decision, generation):
+        # `generation` is the grant generation the decision was computed
+        # in; decisions computed before the latest change are dropped.
+        with self._lock:
+            current = getGeneration()
+            if generation != current:
+                return
+            if self._generation != current or len(self._data) >= self.maxsize:
+                self._data = {}
+                self._generation = current
+            self._data[key] = decision
+
+
+class SharedGroupsCache:
+    """Process-wide cache of the groups of principals.
+
+    Looking up the groups of groups, as the policy does for every new
+    interaction, can be expensive with authentication utilities backed by
+    LDAP or SQL.  The cache keeps the group trees of at most `maxsize`
+    principals for `ttl` seconds, per authentication utility, as sites
+    can have their own.  A principal's entry is only used as long as its
+    direct groups didn't change; `invalidate` drops entries when other
+    changes must be seen earlier.
+    """
+
+    _clock = staticmethod(time.monotonic)
+
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, auth, principal_id, direct_groups):
+        key = _authKey(auth), principal_id
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, direct, groups = entry
+            if expires <= self._clock() or direct != tuple(direct_groups):
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return groups
+
+    def set(self, auth, principal_id, direct_groups, groups):
+        key = _authKey(auth), principal_id
+        with self._lock:
+            self._data[key] = (
+                self._clock() + self.ttl, tuple(direct_groups), groups)
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, principal_id=None):
+        """Forget the groups of a principal or of all principals.
+
+        Entries of principals that are members of `principal_id`,
+        directly or not, are dropped as well, for all authentication
+        utilities.
+        """
+        with self._lock:
+            if principal_id is None:
+                self._data.clear()
+                return
+            for key, (expires, direct, groups) in list(self._data.items()):
+                if (key[1] == principal_id
+                        or _inGroups(principal_id, groups)):
+                    del self._data[key]
+
+
+def _authKey(auth):
+    # Persistent utilities are loaded once per connection, so they are
+    # told apart by their persistent id.
+    key = _persistentId(auth)
+    return auth if key is None else key
+
+
+def _inGroups(group_id, groups):
+    # Groups reached along several paths share their tuples (see
+    # _findGroupsFor), which are only looked at once.
+    seen = set()
+    todo = [groups]
+    while todo:
+        groups = todo.pop()
+        if id(groups) in seen:
+            continue
+        seen.add(id(groups))
+        for member_id, subgroups in groups:
+            if member_id == group_id:
+                return True
+            todo.append(subgroups)
+    return False
+
+
+def _groupsKey(groups, memo=None):
+    # Return a digest of a tree of groups for the keys of the shared
+    # decision cache.  Hashing the tree itself would walk shared subtrees
+    # once for every path to them; here each is digested once.
+    if memo is None:
+        memo = {}
+    key = memo.get(id(groups))
+    if key is None:
+        digest = hashlib.sha256()
+        for group_id, subgroups in groups:
+            digest.update(
+                repr((group_id, _groupsKey(subgroups, memo))).encode())
+        key = memo[id(groups)] = digest.digest()
+    return key
+
+
+def _persistentId(ob):
+    # Return the persistent id of `ob`, or None if it is transient.
+    oid = getattr(ob, '_p_oid', None)
+    if oid is None:
+        return None
+    try:
+        return ob._p_jar.db().database_name, oid
+    except AttributeError:
+        return oid
+
+
 @zope.interface.provider(ISecurityPolicy)
 class ZopeSecurityPolicy(ParanoidSecurityPolicy):
 
+    # Set to a `SharedDecisionCache` to share decisions between
+    # interactions.
+    shared_cache = None
+
+    # Set to a `SharedGroupsCache` to share the groups of principals
+    # between interactions.
+    groups_cache = None
+
+    # The number of objects an interaction caches grants and decisions
+    # for.  The least recently used objects are dropped first.  None
+    # means no limit.
+    cache_size = 10000
+
+    # Whether role based grants are decided on sets of roles represented
+    # as bit masks (see `zope.securitypolicy.rolemask`) rather than
+    # dictionaries.
+    role_masks = False
+
+    # Whether the grants made on an object are looked up through a single
+    # `IGrantInfo` adapter where one is registered, instead of through
+    # the principal permission, role permission and principal role maps.
+    # Only turn this on if the grant info knows about all grants, which
+    # isn't the case when applications register their own maps.
+    use_grant_info = False
+
+    # Whether only objects providing `IHasLocalGrants` are looked at for
+    # local grants, so that the annotations of all others don't need to
+    # be loaded.  Only turn this on once all objects with grants have the
+    # marker (see `securitymap.updateLocalGrantsMarker`) and if there are
+    # no grants other than those of the annotation security maps.  Objects
+    # that can't be marked, such as those with __slots__, are always
+    # looked at.
+    local_grants_marker = False
+
     def __init__(self, *args, **kw):
         ParanoidSecurityPolicy.__init__(self, *args, **kw)
-        self._cache = {}
+        self._cache = OrderedDict()
+        self._clearTree()
+        # Bumped whenever grants change (see _verify)
+        self._epoch = 0
+        self._groups = {}
+        self._groupsKeys = {}
+        # Interactions usually start before their transaction does, so
+        # decisions computed by us are only worth sharing as long as no
+        # grants changed since we were created.
+        self._generation = getGeneration()
 
     def invalidate_cache(self):
-        self._cache = {}
+        self._cache = OrderedDict()
+        self._clearTree()
+        self._groups = {}
+        self._groupsKeys = {}
+
+    def _clearTree(self):
+        # The cached objects and their ancestors form a tree, which we
+        # keep by the ids of the objects as we get them, so that we can
+        # find what is cached below an object.  Grants may be changed
+        # through other proxies of an object, so the nodes are also found
+        # by the id of the object without any proxies.
+        self._parents = {}
+        self._children = {}
+        self._unwrapped = {}
+        self._nodes = {}
+
+    def _link(self, key, ob):
+        # Add an object and its ancestors to the tree, up to the first
+        # one that is in it already.
+        parents = self._parents
+        children = self._children
+        while key not in parents:
+            unwrapped = self._unwrapped[key] = id(removeAllProxies(ob))
+            nodes = self._nodes.get(unwrapped)
+            if nodes is None:
+                nodes = self._nodes[unwrapped] = set()
+            nodes.add(key)
+            parent = removeSecurityProxy(getattr(ob, '__parent__', None))
+            if parent is None:
+                parents[key] = None
+                break
+            parent_key = id(parent)
+            parents[key] = parent_key
+            siblings = children.get(parent_key)
+            if siblings is None:
+                siblings = children[parent_key] = set()
+            siblings.add(key)
+            key, ob = parent_key, parent
+
+    def _unlink(self, key):
+        # Remove an object that is no longer cached from the tree, and
+        # then its ancestors that are neither cached nor have other
+        # descendants that are.
+        parents = self._parents
+        children = self._children
+        while (key in parents and key not in self._cache
+               and not children.get(key)):
+            children.pop(key, None)
+            unwrapped = self._unwrapped.pop(key)
+            nodes = self._nodes[unwrapped]
+            nodes.discard(key)
+            if not nodes:
+                del self._nodes[unwrapped]
+            parent_key = parents.pop(key)
+            if parent_key is None:
+                break
+            siblings = children.get(parent_key)
+            if siblings is not None:
+                siblings.discard(key)
+            key = parent_key
+
+    def _drop(self, key):
+        # Forget what we cached for an object
+        if self._cache.pop(key, None) is not None:
+            self._unlink(key)
+
+    def _verify(self, key, ob):
+        # Objects may have been moved since they were linked into the
+        # tree, and grants changed since on their new ancestors wouldn't
+        # have invalidated them.  So the first time an entry is used after
+        # grants changed, check that the tree still has the parents of the
+        # object and of its ancestors, up to one checked already.  Return
+        # whether it does; the entries on the way are then checked too.
+        epoch = self._epoch
+        parents = self._parents
+        checked = []
+        while True:
+            cached = self._cache.get(key)
+            if cached is not None:
+                if cached[0].checked == epoch:
+                    break
+                checked.append(cached[0])
+            parent = removeSecurityProxy(getattr(ob, '__parent__', None))
+            parent_key = None if parent is None else id(parent)
+            if key not in parents or parents[key] != parent_key:
+                return False
+            if parent is None:
+                break
+            key, ob = parent_key, parent
+        for cache in checked:
+            cache.checked = epoch
+        return True
+
+    def invalidate_cache_for(self, ob):
+        """Forget what was cached for an object and the objects below it.
+
+        This is called when grants on `ob` change, which can only affect
+        decisions on `ob` and its descendants.  If `ob` is None, global
+        grants changed and all cached objects are affected.  Group trees
+        don't depend on grants and are kept.
+        """
+        self._epoch += 1
+        if ob is None:
+            self._cache = OrderedDict()
+            self._clearTree()
+            return
+
+        # Only objects in the tree below `ob` can be affected.  If `ob`
+        # isn't in the tree, nothing cached depends on it.
+        cache = self._cache
+        children = self._children
+        keys = list(self._nodes.get(id(removeAllProxies(ob)), ()))
+        for key in keys:
+            cache.pop(key, None)
+            keys.extend(children.get(key, ()))
+        # Descendants first, so that ancestors are left without them
+        for key in reversed(keys):
+            self._unlink(key)
 
     def cache(self, parent):
-        cache = self._cache.get(id(parent))
-        if cache:
-            cache = cache[0]
+        # Entries are keyed by object identity.  Objects are referenced
+        # weakly where possible, so that they, ZODB ghosts in particular,
+        # can go away while we keep working; their entries are dropped
+        # when they do.  Other objects are held on to until they are
+        # evicted, so that their id can't be reused meanwhile.
+        key = id(parent)
+        cached = self._cache.get(key)
+        if (cached is not None and cached[0].checked != self._epoch
+                and not self._verify(key, parent)):
+            # Objects were moved, so we can't tell what grant changes
+            # affected; forget everything.
+            self._cache = OrderedDict()
+            self._clearTree()
+            cached = None
+        if cached is not None:
+            self._cache.move_to_end(key)
+            cache = cached[0]
         else:
             cache = CacheEntry()
-            self._cache[id(parent)] = cache, parent
+            cache.checked = self._epoch
+            try:
+                ref = weakref.ref(parent, _forget(
+                    self._cache, key, weakref.ref(self)))
+            except TypeError:
+                ref = _StrongRef(parent)
+            self._cache[key] = cache, ref
+            self._link(key, parent)
+            if (self.cache_size is not None
+                    and len(self._cache) > self.cache_size):
+                self._unlink(self._cache.popitem(last=False)[0])
         return cache
 
     def cached_decision(self, parent, principal, groups, permission):
@@ -85,73 +540,172 @@ class ZopeSecurityPolicy(ParanoidSecurityPolicy):
         # cache_decision_prin[permission] is the cached decision for a
         # principal and permission.
 
+        shared = self.shared_cache
+        if shared is None or hasPendingChanges():
+            # Decisions made on grant changes that aren't committed yet
+            # must not be shared, nor can shared ones be used.
+            decision = self._decision(parent, principal, groups, permission)
+        else:
+            key = self._persistent_path(parent, cache)
+            if key is None:
+                decision = self._decision(
+                    parent, principal, groups, permission)
+            else:
+                groups_key = self._groupsKeys.get(principal)
+                if groups_key is None:
+                    groups_key = _groupsKey(groups)
+                key = key, principal, groups_key, permission
+                decision = shared.get(key)
+                if decision is None:
+                    decision = self._decision(
+                        parent, principal, groups, permission)
+                    shared.set(key, decision, self._generation)
+
+        cache_decision_prin[permission] = decision
+        return decision
+
+    def _persistent_path(self, parent, cache):
+        # Return the persistent ids of `parent` and its ancestors, or None
+        # if any of them is transient.  Siblings share their parent's.
+        walked = []
+        while True:
+            try:
+                path = cache.persistent_path
+                break
+            except AttributeError:
+                pass
+            oid = _persistentId(parent)
+            walked.append((cache, oid))
+            if oid is None:
+                path = None
+                break
+            parent = removeSecurityProxy(getattr(parent, '__parent__', None))
+            if parent is None:
+                path = ()
+                break
+            cache = self.cache(parent)
+
+        for cache, oid in reversed(walked):
+            if path is not None and oid is not None:
+                path = (oid, ) + path
+            else:
+                path = None
+            cache.persistent_path = path
+        return path
+
+    def _decision(self, parent, principal, groups, permission):
         decision = self.cached_prinper(parent, principal, groups, permission)
         if (decision is None) and groups:
             decision = self._group_based_cashed_prinper(parent, principal,
                                                         groups, permission)
         if decision is not None:
-            cache_decision_prin[permission] = decision
             return decision
 
+        if self.role_masks:
+            mask = self.cached_role_mask(parent, permission)
+            if mask:
+                allowed, denied = self._effective_principal_role_masks(
+                    parent, principal, groups)
+                return bool(mask & allowed)
+            return False
+
         roles = self.cached_roles(parent, permission)
         if roles:
-            prin_roles = self.cached_principal_roles(parent, principal)
-            if groups:
-                prin_roles = self.cached_principal_roles_w_groups(
-                    parent, principal, groups, prin_roles)
+            prin_roles = self._effective_principal_roles(
+                parent, principal, groups)
             for role, setting in prin_roles.items():
                 if setting and (role in roles):
-                    cache_decision_prin[permission] = decision = True
-                    return decision
+                    return True
 
-        cache_decision_prin[permission] = decision = False
-        return decision
+        return False
 
-    def cached_prinper(self, parent, principal, groups, permission):
-        # Compute the permission, if any, for the principal.
+    def _effective_principal_roles(self, parent, principal, groups):
+        # The roles of a principal including those of its groups, which
+        # are the same for all permissions.
         cache = self.cache(parent)
         try:
-            cache_prin = cache.prin
+            cache_effective_roles = cache.effective_roles
         except AttributeError:
-            cache_prin = cache.prin = {}
-
-        cache_prin_per = cache_prin.get(principal)
-        if not cache_prin_per:
-            cache_prin_per = cache_prin[principal] = {}
-
+            cache_effective_roles = cache.effective_roles = {}
         try:
-            return cache_prin_per[permission]
+            return cache_effective_roles[principal]
         except KeyError:
             pass
 
-        if parent is None:
-            prinper = SettingAsBoolean[
-                globalPrincipalPermissionSetting(permission, principal, None)]
-            cache_prin_per[permission] = prinper
-            return prinper
+        prin_roles = self.cached_principal_roles(parent, principal)
+        if groups:
+            prin_roles = self.cached_principal_roles_w_groups(
+                parent, principal, groups, prin_roles)
+        cache_effective_roles[principal] = prin_roles
+        return prin_roles
+
+    def cached_prinper(self, parent, principal, groups, permission):
+        # Compute the permission, if any, for the principal.  Walk up to
+        # the nearest level that has it cached or a setting for it and
+        # cache it for all levels on the way.
+        walked = []
+        while True:
+            cache = self.cache(parent)
+            try:
+                cache_prin = cache.prin
+            except AttributeError:
+                cache_prin = cache.prin = {}
+
+            cache_prin_per = cache_prin.get(principal)
+            if not cache_prin_per:
+                cache_prin_per = cache_prin[principal] = {}
 
-        prinper = IPrincipalPermissionMap(parent, None)
-        if prinper is not None:
-            prinper = SettingAsBoolean[
-                prinper.getSetting(permission, principal, None)]
+            try:
+                prinper = cache_prin_per[permission]
+                break
+            except KeyError:
+                pass
+
+            walked.append(cache_prin_per)
+            if parent is None:
+                prinper = SettingAsBoolean[
+                    globalPrincipalPermissionSetting(
+                        permission, principal, None)]
+                break
+
+            grant_info = self._grant_info(parent, cache)
+            if grant_info is None:
+                prinper = self._map(parent, cache, IPrincipalPermissionMap)
+                if prinper is not None:
+                    prinper = SettingAsBoolean[
+                        prinper.getSetting(permission, principal, None)]
+            elif grant_info:
+                prinper = SettingAsBoolean[
+                    grant_info.principalPermissionGrant(principal, permission)]
+            else:
+                prinper = None
             if prinper is not None:
-                cache_prin_per[permission] = prinper
-                return prinper
+                break
+
+            parent = removeSecurityProxy(getattr(parent, '__parent__', None))
 
-        parent = removeSecurityProxy(getattr(parent, '__parent__', None))
-        prinper = self.cached_prinper(parent, principal, groups, permission)
-        cache_prin_per[permission] = prinper
+        for cache_prin_per in walked:
+            cache_prin_per[permission] = prinper
         return prinper
 
     def _group_based_cashed_prinper(self, parent, principal, groups,
-                                    permission):
+                                    permission, memo=None):
+        # Groups found through several paths share their group tuples
+        # (see _findGroupsFor), so their decisions are only made once.
+        if memo is None:
+            memo = {}
         denied = False
         for group_id, ggroups in groups:
-            decision = self.cached_prinper(parent, group_id, ggroups,
-                                           permission)
-            if (decision is None) and ggroups:
-                decision = self._group_based_cashed_prinper(
-                    parent, group_id, ggroups, permission)
+            key = group_id, id(ggroups)
+            try:
+                decision = memo[key]
+            except KeyError:
+                decision = self.cached_prinper(parent, group_id, ggroups,
+                                               permission)
+                if (decision is None) and ggroups:
+                    decision = self._group_based_cashed_prinper(
+                        parent, group_id, ggroups, permission, memo)
+                memo[key] = decision
 
             if decision is None:
                 continue
@@ -166,49 +720,127 @@ class ZopeSecurityPolicy(ParanoidSecurityPolicy):
 
         return None
 
-    def cached_roles(self, parent, permission):
-        cache = self.cache(parent)
+    def _grant_info(self, parent, cache):
+        # Look up the grants made on an object at once through IGrantInfo
+        # rather than adapting it to the three maps for every question.
+        # Return None if there is no grant info for it (or use_grant_info
+        # is off), which means that the maps have to be asked.  Grant info
+        # without any grants, or of objects that local_grants_marker tells
+        # us to skip, is false.
         try:
-            cache_roles = cache.roles
+            return cache.grant_info
         except AttributeError:
-            cache_roles = cache.roles = {}
-        try:
-            return cache_roles[permission]
-        except KeyError:
             pass
+        grant_info = None
+        if (self.local_grants_marker
+                and not IHasLocalGrants.providedBy(parent)
+                and canMarkLocalGrants(parent)):
+            grant_info = False
+        elif self.use_grant_info:
+            grant_info = IGrantInfo(parent, None)
+            if grant_info is not None and not grant_info:
+                grant_info = False
+        cache.grant_info = grant_info
+        return grant_info
+
+    def _map(self, parent, cache, iface):
+        # Adapt a level to one of the maps.  Levels without grants, which
+        # most are, are remembered as such for all the principals, roles
+        # and permissions asked about until grant changes drop the entry.
+        # Maps with grants aren't kept, as they reference their object,
+        # which the cache must not keep alive.
+        try:
+            no_grants = cache.no_grants
+        except AttributeError:
+            no_grants = cache.no_grants = set()
+        if iface in no_grants:
+            return None
+        map = iface(parent, None)
+        if not map:
+            no_grants.add(iface)
+            return None
+        return map
+
+    def _role_permission_map(self, parent, cache):
+        grant_info = self._grant_info(parent, cache)
+        if grant_info is None:
+            return self._map(parent, cache, IRolePermissionMap)
+        return grant_info
+
+    def _principal_role_map(self, parent, cache):
+        grant_info = self._grant_info(parent, cache)
+        if grant_info is None:
+            return self._map(parent, cache, IPrincipalRoleMap)
+        return grant_info
+
+    def _uncached(self, parent, name, key):
+        # Walk up from `parent` to the nearest level that has a value for
+        # `key` in its cache called `name`, or to the global level.  Return
+        # that value (None if there is none) and the (object, entry, cache)
+        # triples of the levels without it, outermost first, so that they
+        # can be filled in top-down without recursing.
+        walked = []
+        while True:
+            cache = self.cache(parent)
+            try:
+                cache_for = getattr(cache, name)
+            except AttributeError:
+                cache_for = {}
+                setattr(cache, name, cache_for)
+            try:
+                value = cache_for[key]
+                break
+            except KeyError:
+                pass
+            walked.append((parent, cache, cache_for))
+            if parent is None:
+                value = None
+                break
+            parent = removeSecurityProxy(getattr(parent, '__parent__', None))
+        walked.reverse()
+        return value, walked
 
-        if parent is None:
-            roles = {
-                role: 1
-                for (role, setting) in globalRolesForPermission(permission)
-                if setting is Allow}
+    def cached_roles(self, parent, permission):
+        roles, walked = self._uncached(parent, 'roles', permission)
+        for parent, cache, cache_roles in walked:
+            if parent is None:
+                roles = RoleOverlay({
+                    role: 1
+                    for (role, setting) in globalRolesForPermission(
+                        permission)
+                    if setting is Allow})
+            else:
+                roleper = self._role_permission_map(parent, cache)
+                if roleper:
+                    changes = {}
+                    for role, setting in roleper.getRolesForPermission(
+                            permission):
+                        if setting is Allow:
+                            changes[role] = 1
+                        elif role in roles:
+                            changes[role] = _removed
+                    if changes:
+                        roles = RoleOverlay(changes, roles)
             cache_roles[permission] = roles
-            return roles
-
-        roles = self.cached_roles(
-            removeSecurityProxy(getattr(parent, '__parent__', None)),
-            permission)
-        roleper = IRolePermissionMap(parent, None)
-        if roleper:
-            roles = roles.copy()
-            for role, setting in roleper.getRolesForPermission(permission):
-                if setting is Allow:
-                    roles[role] = 1
-                elif role in roles:
-                    del roles[role]
-
-        cache_roles[permission] = roles
         return roles
 
     def cached_principal_roles_w_groups(self, parent,
-                                        principal, groups, prin_roles):
+                                        principal, groups, prin_roles,
+                                        memo=None):
+        if memo is None:
+            memo = {}
         denied = {}
         allowed = {}
         for group_id, ggroups in groups:
-            group_roles = dict(self.cached_principal_roles(parent, group_id))
-            if ggroups:
-                group_roles = self.cached_principal_roles_w_groups(
-                    parent, group_id, ggroups, group_roles)
+            key = group_id, id(ggroups)
+            try:
+                group_roles = memo[key]
+            except KeyError:
+                group_roles = self.cached_principal_roles(parent, group_id)
+                if ggroups:
+                    group_roles = self.cached_principal_roles_w_groups(
+                        parent, group_id, ggroups, group_roles, memo)
+                memo[key] = group_roles
             for role, setting in group_roles.items():
                 if setting:
                     allowed[role] = setting
@@ -220,42 +852,122 @@ class ZopeSecurityPolicy(ParanoidSecurityPolicy):
         return denied
 
     def cached_principal_roles(self, parent, principal):
+        roles, walked = self._uncached(parent, 'principal_roles', principal)
+        for parent, cache, cache_principal_roles in walked:
+            if parent is None:
+                roles = {
+                    role: SettingAsBoolean[setting]
+                    for (role, setting) in globalRolesForPrincipal(principal)}
+                roles['zope.Anonymous'] = True  # Everybody has Anonymous
+                roles = RoleOverlay(roles)
+            else:
+                prinrole = self._principal_role_map(parent, cache)
+                if prinrole:
+                    changes = {
+                        role: SettingAsBoolean[setting]
+                        for role, setting in prinrole.getRolesForPrincipal(
+                            principal)}
+                    if changes:
+                        roles = RoleOverlay(changes, roles)
+            cache_principal_roles[principal] = roles
+        return roles
+
+    def cached_role_mask(self, parent, permission):
+        # Like cached_roles, but returning a mask of the roles.
+        mask, walked = self._uncached(parent, 'role_masks', permission)
+        for parent, cache, cache_role_masks in walked:
+            if parent is None:
+                mask = globalRoleMaskForPermission(permission)
+            else:
+                roleper = self._role_permission_map(parent, cache)
+                if roleper:
+                    for role, setting in roleper.getRolesForPermission(
+                            permission):
+                        if setting is Allow:
+                            mask |= roleBit(role)
+                        else:
+                            mask &= ~roleBit(role)
+            cache_role_masks[permission] = mask
+        return mask
+
+    def cached_principal_role_masks(self, parent, principal):
+        # Like cached_principal_roles, but returning masks of the roles
+        # assigned to and removed from the principal.
+        masks, walked = self._uncached(
+            parent, 'principal_role_masks', principal)
+        for parent, cache, cache_principal_role_masks in walked:
+            if parent is None:
+                allowed, denied = globalRoleMasksForPrincipal(principal)
+                # Everybody has Anonymous
+                anonymous = roleBit('zope.Anonymous')
+                masks = allowed | anonymous, denied & ~anonymous
+            else:
+                prinrole = self._principal_role_map(parent, cache)
+                if prinrole:
+                    allowed, denied = masks
+                    for role, setting in prinrole.getRolesForPrincipal(
+                            principal):
+                        bit = roleBit(role)
+                        if setting is Allow:
+                            allowed |= bit
+                            denied &= ~bit
+                        else:
+                            allowed &= ~bit
+                            denied |= bit
+                    masks = allowed, denied
+            cache_principal_role_masks[principal] = masks
+        return masks
+
+    def cached_principal_role_masks_w_groups(self, parent, principal,
+                                             groups, masks, memo=None):
+        # Like cached_principal_roles_w_groups: roles assigned to any
+        # group win over roles removed from others, and the principal's
+        # own settings win over those of its groups.
+        if memo is None:
+            memo = {}
+        group_allowed = group_denied = 0
+        for group_id, ggroups in groups:
+            key = group_id, id(ggroups)
+            try:
+                group_masks = memo[key]
+            except KeyError:
+                group_masks = self.cached_principal_role_masks(
+                    parent, group_id)
+                if ggroups:
+                    group_masks = self.cached_principal_role_masks_w_groups(
+                        parent, group_id, ggroups, group_masks, memo)
+                memo[key] = group_masks
+            group_allowed |= group_masks[0]
+            group_denied |= group_masks[1]
+
+        allowed, denied = masks
+        return (allowed | (group_allowed & ~denied),
+                denied | (group_denied & ~group_allowed & ~allowed))
+
+    def _effective_principal_role_masks(self, parent, principal, groups):
         cache = self.cache(parent)
         try:
-            cache_principal_roles = cache.principal_roles
+            cache_effective_role_masks = cache.effective_role_masks
         except AttributeError:
-            cache_principal_roles = cache.principal_roles = {}
+            cache_effective_role_masks = cache.effective_role_masks = {}
         try:
-            return cache_principal_roles[principal]
+            return cache_effective_role_masks[principal]
         except KeyError:
             pass
 
-        if parent is None:
-            roles = {
-                role: SettingAsBoolean[setting]
-                for (role, setting) in globalRolesForPrincipal(principal)}
-            roles['zope.Anonymous'] = True  # Everybody has Anonymous
-            cache_principal_roles[principal] = roles
-            return roles
-
-        roles = self.cached_principal_roles(
-            removeSecurityProxy(getattr(parent, '__parent__', None)),
-            principal)
-
-        prinrole = IPrincipalRoleMap(parent, None)
-        if prinrole:
-            roles = roles.copy()
-            for role, setting in prinrole.getRolesForPrincipal(principal):
-                roles[role] = SettingAsBoolean[setting]
-
-        cache_principal_roles[principal] = roles
-        return roles
+        masks = self.cached_principal_role_masks(parent, principal)
+        if groups:
+            masks = self.cached_principal_role_masks_w_groups(
+                parent, principal, groups, masks)
+        cache_effective_role_masks[principal] = masks
+        return masks
 
     def checkPermission(self, permission, object):
         if permission is CheckerPublic:
             return True
 
         object = removeSecurityProxy(object)
+        permission = internId(permission)
         seen = {}
         for participation in self.participations:
             principal = participation.principal
@@ -266,7 +978,8 @@ class ZopeSecurityPolicy(ParanoidSecurityPolicy):
                 continue
 
             if not self.cached_decision(
-                object, principal.id, self._groupsFor(principal), permission,
+                object, internId(principal.id), self._groupsFor(principal),
+                permission,
             ):
                 return False
 
@@ -274,14 +987,112 @@ class ZopeSecurityPolicy(ParanoidSecurityPolicy):
 
         return True
 
-    def _findGroupsFor(self, principal, getPrincipal, seen):
+    def checkPermissions(self, permissions, object):
+        """Check several permissions on the same object.
+
+        Return a dictionary mapping each permission to whether the
+        interaction has it.  The participating principals and their
+        groups are looked up once, and the grants inherited by the object
+        as well as the roles of the principals are computed once for all
+        permissions.
+        """
+        object = removeSecurityProxy(object)
+        principals = self._principals()
+        result = {}
+        for permission in permissions:
+            if permission is CheckerPublic:
+                result[permission] = True
+                continue
+            permission_id = internId(permission)
+            for principal, groups in principals:
+                if not self.cached_decision(
+                    object, principal, groups, permission_id,
+                ):
+                    result[permission] = False
+                    break
+            else:
+                result[permission] = True
+        return result
+
+    def iterAllowed(self, permission, objects):
+        """Iterate over the objects the interaction has a permission on.
+
+        The grants an object inherits are cached for its parent, so
+        objects sharing ancestors, such as the items of a folder, only
+        cost one walk up their common ancestors.  After that only the
+        grants made on each object itself are looked at.  The objects
+        themselves aren't kept in the cache, so that filtering large
+        numbers of them doesn't push their ancestors out of it.
+        """
+        if permission is CheckerPublic:
+            yield from objects
+            return
+
+        permission = internId(permission)
+        principals = self._principals()
+        for ob in objects:
+            unproxied = removeSecurityProxy(ob)
+            key = id(unproxied)
+            cached = key in self._cache
+            for principal, groups in principals:
+                if not self.cached_decision(
+                    unproxied, principal, groups, permission,
+                ):
+                    allowed = False
+                    break
+            else:
+                allowed = True
+            if not cached:
+                self._drop(key)
+            if allowed:
+                yield ob
+
+    def filterAllowed(self, permission, objects):
+        """Return a list of the objects the interaction has a permission on.
+
+        See `iterAllowed`.
+        """
+        return list(self.iterAllowed(permission, objects))
+
+    def _principals(self):
+        # Return the ids and groups of the participating principals,
+        # leaving out the system user, who is always allowed.
+        principals = []
+        seen = {}
+        for participation in self.participations:
+            principal = participation.principal
+            if principal is system_user or principal.id in seen:
+                continue
+            seen[principal.id] = 1
+            principals.append(
+                (internId(principal.id), self._groupsFor(principal)))
+        return principals
+
+    def _findGroupsFor(self, principal, getPrincipal, seen, memo=None):
+        # ``memo`` maps the ids of groups that were already resolved to
+        # their groups (or None for undefined ones), so that a group
+        # reached along several paths is only looked up and expanded
+        # once and the nested tuples are shared.  Groups whose expansion
+        # skipped a cycle depend on the path they were reached by and
+        # are not memoized.
+        if memo is None:
+            memo = {}
         result = []
         for group_id in getattr(principal, 'groups', ()):
             if group_id in seen:
                 # Dang, we have a cycle.  We don't want to
                 # raise an exception here (or do we), so we'll skip it
+                memo[_skipped] = True
+                continue
+
+            try:
+                groups = memo[group_id]
+            except KeyError:
+                pass
+            else:
+                if groups is not None:
+                    result.append((internId(group_id), groups))
                 continue
-            seen.append(group_id)
 
             try:
                 group = getPrincipal(group_id)
@@ -289,25 +1100,43 @@ class ZopeSecurityPolicy(ParanoidSecurityPolicy):
                 # It's bad if we have an undefined principal,
                 # but we don't want to fail here.  But we won't
                 # honor any grants for the group. We'll just skip it.
+                memo[group_id] = None
                 continue
 
-            result.append((group_id,
-                           self._findGroupsFor(group, getPrincipal, seen)))
+            seen.append(group_id)
+            skipped = memo.pop(_skipped, False)
+            groups = self._findGroupsFor(group, getPrincipal, seen, memo)
+            if memo.pop(_skipped, False):
+                skipped = True
+            else:
+                memo[group_id] = groups
+            if skipped:
+                memo[_skipped] = True
+            result.append((internId(group_id), groups))
             seen.pop()
 
         return tuple(result)
 
     def _groupsFor(self, principal):
-        groups = self._cache.get(principal.id)
+        groups = self._groups.get(principal.id)
         if groups is None:
-            groups = getattr(principal, 'groups', ())
-            if groups:
-                getPrincipal = getUtility(IAuthentication).getPrincipal
-                groups = self._findGroupsFor(principal, getPrincipal, [])
+            direct = getattr(principal, 'groups', ())
+            if direct:
+                auth = getUtility(IAuthentication)
+                shared = self.groups_cache
+                if shared is not None:
+                    groups = shared.get(auth, principal.id, direct)
+                if groups is None:
+                    groups = self._findGroupsFor(
+                        principal, auth.getPrincipal, [])
+                    if shared is not None:
+                        shared.set(auth, principal.id, direct, groups)
             else:
                 groups = ()
 
-            self._cache[principal.id] = groups
+            self._groups[principal.id] = groups
+            if self.shared_cache is not None:
+                self._groupsKeys[principal.id] = _groupsKey(groups)
 
         return groups
 
@@ -362,3 +1191,88 @@ def settingsForObject(ob):
         for (p, r, s) in sorted(settings)]
 
     return result
+
+
+def _iterMethod(map, name):
+    # The iter<name> method of a map, or an iterator over the result of
+    # get<name> for maps that don't have the iter* methods.
+    method = getattr(map, 'iter' + name, None)
+    if method is None:
+        get = getattr(map, 'get' + name)
+
+        def method(*args):
+            return iter(get(*args))
+    return method
+
+
+def _iterCells(map, row, col, all, rowentry, colentry):
+    # The (row, column, setting) cells of a map, looked up by column or
+    # row rather than filtered from all cells where we can.
+    if colentry is not None:
+        for r, s in _iterMethod(map, col)(colentry):
+            if rowentry is None or r == rowentry:
+                yield r, colentry, s
+    elif rowentry is not None:
+        for c, s in _iterMethod(map, row)(rowentry):
+            yield rowentry, c, s
+    else:
+        yield from _iterMethod(map, all)()
+
+
+def _iterSettings(level, principalPermissions, principalRoles,
+                  rolePermissions, principal, permission, role):
+    if principalPermissions is not None and role is None:
+        for p, pr, s in _iterCells(
+                principalPermissions, 'PrincipalsForPermission',
+                'PermissionsForPrincipal', 'PrincipalsAndPermissions',
+                permission, principal):
+            yield level, 'principalPermissions', pr, p, s
+
+    if principalRoles is not None and permission is None:
+        for r, pr, s in _iterCells(
+                principalRoles, 'PrincipalsForRole', 'RolesForPrincipal',
+                'PrincipalsAndRoles', role, principal):
+            yield level, 'principalRoles', pr, r, s
+
+    if rolePermissions is not None and principal is None:
+        for p, r, s in _iterCells(
+                rolePermissions, 'RolesForPermission', 'PermissionsForRole',
+                'RolesAndPermissions', permission, role):
+            yield level, 'rolePermissions', r, p, s
+
+
+def _iterSettingsForObject(ob, principal, permission, role):
+    while ob is not None:
+        yield from _iterSettings(
+            getattr(ob, '__name__', '(no name)'),
+            IPrincipalPermissionMap(ob, None),
+            IPrincipalRoleMap(ob, None),
+            IRolePermissionMap(ob, None),
+            principal, permission, role)
+        ob = getattr(ob, '__parent__', None)
+
+    yield from _iterSettings(
+        'global settings', principalPermissionManager, principalRoleManager,
+        rolePermissionManager, principal, permission, role)
+
+
+def iterSettingsForObject(ob, principal=None, permission=None, role=None,
+                          offset=0, limit=None):
+    """Iterate over the grants to a process, like settingsForObject
+
+    Yield (level, kind, id, id, setting) tuples, from the object up to its
+    root and then for the global settings.  The level is the name of the
+    object, or 'global settings', and the kind is one of
+    'principalPermissions', 'principalRoles' and 'rolePermissions'.  The
+    ids are those of the principal and permission, of the principal and
+    role, and of the role and permission, respectively.  The settings of
+    a level are not sorted.
+
+    Only the settings of the given principal, permission and role are
+    yielded; settings that don't involve one of them are left out.  The
+    first offset settings are skipped, and at most limit are yielded.
+    Ancestors and grants are only looked at when they are reached.
+    """
+    return itertools.islice(
+        _iterSettingsForObject(ob, principal, permission, role),
+        offset, None if limit is None else offset + limit)